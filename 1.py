@@ -1,4 +1,5 @@
-from telethon import TelegramClient, events
+from telethon import TelegramClient, events, utils
+from telethon.errors import FloodWaitError
 from telethon.tl.types import PeerChat, PeerChannel, InputPeerChannel, InputPeerUser, InputPeerChat
 import asyncio
 import random
@@ -7,21 +8,203 @@ import json
 import os
 import time
 import re
-import nltk
-from nltk.tokenize import word_tokenize
-from collections import defaultdict, Counter
+import bisect
+import heapq
+import functools
+import threading
+import contextlib
+import itertools
+import atexit
+import argparse
+import mmap
+import struct
+import sys
+import math
+import zlib
+import hashlib
+import multiprocessing
+from collections import defaultdict, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+from queue import Empty, SimpleQueue
+from array import array
+
+# numpy импортируется долго и нужен только индексу поиска: загружается при создании первого индекса
+np = None
+_numpy_loaded = False
+
+def load_numpy():
+    """Импортирует numpy при первом вызове; без него поиск похожих сообщений работает медленнее."""
+    global np, _numpy_loaded
+    if not _numpy_loaded:
+        try:
+            import numpy as np
+        except ImportError:
+            np = None
+        # Флаг ставится после импорта: индекс в другом потоке не увидит np=None до загрузки
+        _numpy_loaded = True
+    return np
 
 # Настройка логирования
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                    level=logging.INFO,
-                    filename='telegram_bot.log')
+def setup_logging(log_file='telegram_bot.log', level=logging.INFO):
+    """Направляет записи лога через очередь; в файл их пишет отдельный поток."""
+    handler = logging.FileHandler(log_file, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    log_queue = SimpleQueue()
+    listener = QueueListener(log_queue, handler)
+    root = logging.getLogger()
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(level)
+    listener.start()
+    # Перед выходом дописываем все, что осталось в очереди
+    atexit.register(listener.stop)
+    return listener
+
+def set_log_level(level):
+    try:
+        logging.getLogger().setLevel(str(level).upper())
+    except ValueError:
+        logger.error(f"Неизвестный уровень логирования: {level}")
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
-# Загрузка необходимых ресурсов NLTK
-try:
-    nltk.data.find('tokenizers/punkt')
-except LookupError:
-    nltk.download('punkt')
+# Гистограмма длительностей
+class Histogram:
+    """Число наблюдений по корзинам с фиксированными верхними границами (в секундах)."""
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)  # Последняя корзина - +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+# Реестр метрик
+class MetricsRegistry:
+    """Счетчики и гистограммы этапов обработки в текстовом формате Prometheus.
+
+    Метрики обновляются и из цикла событий, и из рабочих потоков, поэтому
+    под блокировкой. Показатели, которые компоненты уже считают сами
+    (stats()), подключаются функциями-сборщиками и читаются при выгрузке.
+    """
+    STAGE_METRIC = 'bot_stage_seconds'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)  # (имя, метки) -> значение
+        self.histograms = {}  # (имя, метки) -> Histogram
+        self.collectors = {}  # имя -> функция, возвращающая [(метрика, метки, значение)]
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] += value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        """Замеряет длительность этапа обработки."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(self.STAGE_METRIC, time.perf_counter() - started, stage=stage)
+
+    def register(self, name, collector):
+        """Подключает сборщик показателей (повторная регистрация под тем же именем заменяет его)."""
+        self.collectors[name] = collector
+
+    @staticmethod
+    def _labels(labels, **extra):
+        items = list(labels) + list(extra.items())
+        if not items:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                              for k, v in items) + '}'
+
+    def render(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(h.counts), h.sum, h.count)) for key, h in self.histograms.items())
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f"{name}{self._labels(labels)} {value!r}")
+        for (name, labels), (counts, total, count) in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, bucket in zip(Histogram.BUCKETS + ('+Inf',), counts):
+                cumulative += bucket
+                lines.append(f"{name}_bucket{self._labels(labels, le=bound)} {cumulative}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total!r}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        for collector_name, collector in list(self.collectors.items()):
+            try:
+                samples = sorted(collector(), key=lambda sample: sample[0])
+            except Exception as e:
+                logger.error(f"Ошибка сборщика метрик {collector_name}: {e}")
+                continue
+            for name, labels, value in samples:
+                header(name, 'gauge')
+                lines.append(f"{name}{self._labels(sorted(labels.items()))} {float(value)!r}")
+        return '\n'.join(lines) + '\n'
+
+    async def _handle_http(self, reader, writer):
+        try:
+            # Запрос не разбираем: по любому пути отдаем метрики
+            await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=5)
+            body = self.render().encode('utf-8')
+            writer.write(b'HTTP/1.1 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                         b'Connection: close\r\n\r\n' + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def start_server(self, port, host='127.0.0.1'):
+        """Запускает локальный HTTP-сервер, отдающий метрики в формате Prometheus."""
+        return await asyncio.start_server(self._handle_http, host, port)
+
+    def dump(self, metrics_file, text=None):
+        """Сохраняет метрики в файл (для textfile-коллектора или ручного просмотра).
+
+        Сборщики читают состояние бота, поэтому text лучше получить через
+        render() в цикле событий, а в рабочем потоке только записать его.
+        """
+        if text is None:
+            text = self.render()
+        tmp_file = metrics_file + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_file, metrics_file)
+
+metrics = MetricsRegistry()
 
 # Конфигурация бота
 class BotConfig:
@@ -40,6 +223,53 @@ class BotConfig:
                 self.response_delay = config.get('response_delay', {'min': 1, 'max': 5})
                 self.message_probability = config.get('message_probability', 0.7)
                 self.learning_enabled = config.get('learning_enabled', True)
+                self.pattern_limit = config.get('pattern_limit', 5000)
+                self.response_limit = config.get('response_limit', 2000)
+                self.eviction_policy = config.get('eviction_policy', 'fifo')
+                self.tokenizer = config.get('tokenizer', 'regex')
+                self.worker_threads = config.get('worker_threads', 2)
+                self.learn_queue_size = config.get('learn_queue_size', 1000)
+                self.learn_batch_size = config.get('learn_batch_size', 100)
+                self.per_chat_models = config.get('per_chat_models', True)
+                self.shared_model = config.get('shared_model', True)
+                self.models_dir = config.get('models_dir', 'chat_models')
+                self.model_idle_timeout = config.get('model_idle_timeout', 1800)
+                self.max_loaded_models = config.get('max_loaded_models', 50)
+                self.model_memory_budget_mb = config.get('model_memory_budget_mb', 0)
+                self.entity_cache_file = config.get('entity_cache_file', 'entity_cache.json')
+                self.entity_ttl = config.get('entity_ttl', 86400)
+                self.entity_negative_ttl = config.get('entity_negative_ttl', 300)
+                self.initiate_concurrency = config.get('initiate_concurrency', 5)
+                self.send_rate_per_chat = config.get('send_rate_per_chat', 0.5)
+                self.send_burst_per_chat = config.get('send_burst_per_chat', 3)
+                self.send_rate_global = config.get('send_rate_global', 5)
+                self.send_burst_global = config.get('send_burst_global', 10)
+                self.send_queue_size = config.get('send_queue_size', 20)
+                self.send_drop_policy = config.get('send_drop_policy', 'oldest')
+                self.send_max_retries = config.get('send_max_retries', 3)
+                self.reply_quiet_period = config.get('reply_quiet_period', 3)
+                self.reply_max_wait = config.get('reply_max_wait', 15)
+                self.reply_window = config.get('reply_window', 10)
+                self.max_inflight_replies = config.get('max_inflight_replies', 1)
+                self.log_level = config.get('log_level', 'INFO')
+                self.metrics_port = config.get('metrics_port', 0)
+                self.metrics_file = config.get('metrics_file', '')
+                self.model_decay_interval = config.get('model_decay_interval', 604800)
+                self.model_decay_factor = config.get('model_decay_factor', 0.9)
+                self.model_min_count = config.get('model_min_count', 1)
+                self.model_max_transitions = config.get('model_max_transitions', 0)
+                self.retrieval_enabled = config.get('retrieval_enabled', True)
+                self.retrieval_min_score = config.get('retrieval_min_score', 0.2)
+                self.response_cache_size = config.get('response_cache_size', 500)
+                self.response_cache_pool = config.get('response_cache_pool', 3)
+                self.cursor_file = config.get('cursor_file', 'chat_cursors.json')
+                self.catch_up_enabled = config.get('catch_up_enabled', True)
+                self.catch_up_concurrency = config.get('catch_up_concurrency', 3)
+                self.catch_up_batch = config.get('catch_up_batch', 500)
+                self.catch_up_limit = config.get('catch_up_limit', 10000)
+                self.worker_sessions = config.get('worker_sessions', [])
+                self.shard_sync_interval = config.get('shard_sync_interval', 60)
+                self.startup_concurrency = config.get('startup_concurrency', 10)
                 print(f"Загружена конфигурация: {self.chat_ids}")
         else:
             # Значения по умолчанию если конфигурационный файл отсутствует
@@ -50,6 +280,53 @@ class BotConfig:
             self.response_delay = {'min': 1, 'max': 5}  # Задержка в секундах перед ответом
             self.message_probability = 0.7  # Вероятность ответа на сообщение
             self.learning_enabled = True
+            self.pattern_limit = 5000  # Сколько паттернов сообщений хранить
+            self.response_limit = 2000  # Сколько ответов хранить в каждой категории
+            self.eviction_policy = 'fifo'  # Политика вытеснения: 'fifo' или 'lru'
+            self.tokenizer = 'regex'  # Токенизатор: 'regex' или 'nltk'
+            self.worker_threads = 2  # Потоки для обучения, генерации и сохранения
+            self.learn_queue_size = 1000  # Максимум сообщений, ожидающих обучения
+            self.learn_batch_size = 100  # Сколько сообщений обучать за один проход
+            self.per_chat_models = True  # Отдельная модель для каждого чата
+            self.shared_model = True  # Общая модель как запасной вариант для моделей чатов
+            self.models_dir = 'chat_models'  # Каталог с моделями чатов
+            self.model_idle_timeout = 1800  # Через сколько секунд простоя выгружать модель чата
+            self.max_loaded_models = 50  # Максимум моделей чатов в памяти
+            self.model_memory_budget_mb = 0  # Бюджет памяти на модели чатов, 0 - без ограничения
+            self.entity_cache_file = 'entity_cache.json'  # Файл кэша чатов и пользователей
+            self.entity_ttl = 86400  # Время жизни записи кэша, сек
+            self.entity_negative_ttl = 300  # Сколько помнить неудачный запрос сущности, сек
+            self.initiate_concurrency = 5  # Сколько чатов одновременно могут начинать диалог
+            self.send_rate_per_chat = 0.5  # Сообщений в секунду в один чат
+            self.send_burst_per_chat = 3  # Сколько сообщений подряд можно отправить в чат
+            self.send_rate_global = 5  # Сообщений в секунду во все чаты
+            self.send_burst_global = 10
+            self.send_queue_size = 20  # Максимум сообщений в очереди одного чата
+            self.send_drop_policy = 'oldest'  # Что отбрасывать при переполнении: 'oldest' или 'newest'
+            self.send_max_retries = 3  # Сколько раз повторять отправку после FloodWait
+            self.reply_quiet_period = 3  # Сколько секунд тишины в чате ждать перед ответом
+            self.reply_max_wait = 15  # Максимальное ожидание ответа при непрерывном потоке сообщений
+            self.reply_window = 10  # Сколько последних сообщений учитывать при ответе
+            self.max_inflight_replies = 1  # Максимум готовящихся ответов в одном чате
+            self.log_level = 'INFO'  # Уровень логирования; DEBUG включает подробности по каждому сообщению
+            self.metrics_port = 0  # Порт HTTP-эндпоинта метрик на 127.0.0.1, 0 - выключен
+            self.metrics_file = ''  # Файл, куда раз в минуту выгружаются метрики, пустая строка - не выгружать
+            self.model_decay_interval = 604800  # За сколько секунд проходить всю модель с затуханием, 0 - без затухания
+            self.model_decay_factor = 0.9  # Во сколько раз уменьшаются частоты за один проход
+            self.model_min_count = 1  # Переходы реже этого удаляются
+            self.model_max_transitions = 0  # Бюджет переходов в одной модели, 0 - без ограничения
+            self.retrieval_enabled = True  # Искать похожие сохраненные сообщения, если цепочка слов не строится
+            self.retrieval_min_score = 0.2  # Минимальная близость найденного сообщения (0..1)
+            self.response_cache_size = 500  # Для скольких стартовых слов готовить ответы в простое, 0 - не готовить
+            self.response_cache_pool = 3  # Сколько готовых ответов держать на одно стартовое слово
+            self.cursor_file = 'chat_cursors.json'  # Файл с id последних изученных сообщений чатов
+            self.catch_up_enabled = True  # Догружать сообщения, пропущенные пока бот был остановлен или без связи
+            self.catch_up_concurrency = 3  # Сколько чатов догружать одновременно
+            self.catch_up_batch = 500  # Сколько догруженных сообщений обучать за один проход
+            self.catch_up_limit = 10000  # Максимум догружаемых сообщений одного чата, 0 - без ограничения
+            self.worker_sessions = []  # Сессии процессов-обработчиков для режима --supervisor
+            self.shard_sync_interval = 60  # Как часто обновлять снимки моделей для обработчиков, сек
+            self.startup_concurrency = 10  # Сколько чатов одновременно проверять и приветствовать при запуске
             self.save_config()
     
     def save_config(self):
@@ -60,15 +337,1173 @@ class BotConfig:
             'chat_ids': self.chat_ids,
             'response_delay': self.response_delay,
             'message_probability': self.message_probability,
-            'learning_enabled': self.learning_enabled
+            'learning_enabled': self.learning_enabled,
+            'pattern_limit': self.pattern_limit,
+            'response_limit': self.response_limit,
+            'eviction_policy': self.eviction_policy,
+            'tokenizer': self.tokenizer,
+            'worker_threads': self.worker_threads,
+            'learn_queue_size': self.learn_queue_size,
+            'learn_batch_size': self.learn_batch_size,
+            'per_chat_models': self.per_chat_models,
+            'shared_model': self.shared_model,
+            'models_dir': self.models_dir,
+            'model_idle_timeout': self.model_idle_timeout,
+            'max_loaded_models': self.max_loaded_models,
+            'model_memory_budget_mb': self.model_memory_budget_mb,
+            'entity_cache_file': self.entity_cache_file,
+            'entity_ttl': self.entity_ttl,
+            'entity_negative_ttl': self.entity_negative_ttl,
+            'initiate_concurrency': self.initiate_concurrency,
+            'send_rate_per_chat': self.send_rate_per_chat,
+            'send_burst_per_chat': self.send_burst_per_chat,
+            'send_rate_global': self.send_rate_global,
+            'send_burst_global': self.send_burst_global,
+            'send_queue_size': self.send_queue_size,
+            'send_drop_policy': self.send_drop_policy,
+            'send_max_retries': self.send_max_retries,
+            'reply_quiet_period': self.reply_quiet_period,
+            'reply_max_wait': self.reply_max_wait,
+            'reply_window': self.reply_window,
+            'max_inflight_replies': self.max_inflight_replies,
+            'log_level': self.log_level,
+            'metrics_port': self.metrics_port,
+            'metrics_file': self.metrics_file,
+            'model_decay_interval': self.model_decay_interval,
+            'model_decay_factor': self.model_decay_factor,
+            'model_min_count': self.model_min_count,
+            'model_max_transitions': self.model_max_transitions,
+            'retrieval_enabled': self.retrieval_enabled,
+            'retrieval_min_score': self.retrieval_min_score,
+            'response_cache_size': self.response_cache_size,
+            'response_cache_pool': self.response_cache_pool,
+            'cursor_file': self.cursor_file,
+            'catch_up_enabled': self.catch_up_enabled,
+            'catch_up_concurrency': self.catch_up_concurrency,
+            'catch_up_batch': self.catch_up_batch,
+            'catch_up_limit': self.catch_up_limit,
+            'worker_sessions': self.worker_sessions,
+            'shard_sync_interval': self.shard_sync_interval,
+            'startup_concurrency': self.startup_concurrency
         }
         with open(self.config_file, 'w', encoding='utf-8') as f:
             json.dump(config, f, indent=4, ensure_ascii=False)
 
+# Токенизаторы сообщений
+class RegexTokenizer:
+    """Быстрый токенизатор на предкомпилированном регулярном выражении.
+
+    Выделяет слова (в том числе через дефис и апостроф), эмодзи вместе с
+    модификаторами и составными последовательностями, многоточие и
+    отдельные знаки препинания.
+    """
+    name = 'regex'
+    EMOJI = '[\U0001F000-\U0001FAFF\u2600-\u27BF][\uFE0F\U0001F3FB-\U0001F3FF]*'
+    PATTERN = re.compile(
+        "\\w+(?:[-'\u2019]\\w+)*"
+        f"|{EMOJI}(?:\u200D{EMOJI})*"
+        "|\\.\\.\\.|[^\\w\\s]"
+    )
+
+    def tokenize(self, text):
+        return self.PATTERN.findall(text)
+
+class NltkTokenizer:
+    """Токенизатор NLTK (Punkt); nltk импортируется только при выборе этого варианта."""
+    name = 'nltk'
+
+    def __init__(self, language='russian'):
+        import nltk
+        from nltk.tokenize import word_tokenize
+        # Загрузка необходимых ресурсов NLTK
+        try:
+            nltk.data.find('tokenizers/punkt')
+        except LookupError:
+            nltk.download('punkt')
+        self.language = language
+        self._word_tokenize = word_tokenize
+
+    def tokenize(self, text):
+        return self._word_tokenize(text, language=self.language)
+
+class CachedTokenizer:
+    """Кэширует результат токенизации, чтобы одно сообщение не разбиралось дважды."""
+    def __init__(self, backend, maxsize=4096):
+        self.backend = backend
+        self.name = backend.name
+        # Кортеж, чтобы закэшированный результат нельзя было случайно изменить
+        self._cached = functools.lru_cache(maxsize=maxsize)(lambda text: tuple(backend.tokenize(text)))
+
+    def tokenize(self, text):
+        return self._cached(text)
+
+    def cache_info(self):
+        return self._cached.cache_info()
+
+TOKENIZERS = {
+    'regex': RegexTokenizer,
+    'nltk': NltkTokenizer,
+}
+
+def make_tokenizer(name='regex', cache_size=4096):
+    """Создает токенизатор по имени; при недоступности nltk используется регулярное выражение."""
+    try:
+        backend = TOKENIZERS[name]()
+    except KeyError:
+        logger.error(f"Неизвестный токенизатор {name}, используется regex")
+        backend = RegexTokenizer()
+    except (ImportError, LookupError, OSError) as e:
+        logger.error(f"Токенизатор {name} недоступен ({e}), используется regex")
+        backend = RegexTokenizer()
+    return CachedTokenizer(backend, cache_size) if cache_size else backend
+
+# Таблица строк в двоичном снимке
+class StringTable:
+    """Строки в буфере: количество, смещения u64[n + 1], затем байты UTF-8 подряд.
+
+    Строки декодируются только при обращении, буфер может быть отображен из файла.
+    """
+    def __init__(self, buffer):
+        count = struct.unpack_from('=Q', buffer, 0)[0]
+        end = 8 * (count + 2)
+        self._offsets = buffer[8:end].cast('Q')
+        self._data = buffer[end:]
+
+    @staticmethod
+    def pack(items):
+        """Упаковывает последовательность bytes в таблицу."""
+        offsets = array('Q', [0])
+        data = bytearray()
+        for item in items:
+            data += item
+            offsets.append(len(data))
+        return struct.pack('=Q', len(offsets) - 1) + offsets.tobytes() + bytes(data)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def raw(self, index):
+        return bytes(self._data[self._offsets[index]:self._offsets[index + 1]])
+
+    def __getitem__(self, index):
+        return self.raw(index).decode('utf-8')
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+# Словарь токенов
+class Vocabulary:
+    """Слова по целочисленным id.
+
+    Слова из снимка лежат в StringTable и ищутся двоичным поиском по индексу,
+    отсортированному по UTF-8; найденные слова запоминаются в словаре.
+    Новые слова получают id после слов снимка.
+    """
+    def __init__(self, table=None, index=None):
+        self._table = table
+        self._index = index  # id слов снимка в порядке возрастания их UTF-8
+        self._base_size = len(table) if table is not None else 0
+        self._new = []
+        self._ids = {}  # слово -> id: новые слова и уже найденные слова снимка
+
+    def __len__(self):
+        return self._base_size + len(self._new)
+
+    def __getitem__(self, word_id):
+        if word_id < self._base_size:
+            return self._table[word_id]
+        return self._new[word_id - self._base_size]
+
+    def __iter__(self):
+        for word_id in range(len(self)):
+            yield self[word_id]
+
+    def raw(self, word_id):
+        """Слово в UTF-8 (слова снимка не декодируются)."""
+        if word_id < self._base_size:
+            return self._table.raw(word_id)
+        return self._new[word_id - self._base_size].encode('utf-8')
+
+    def get(self, word):
+        word_id = self._ids.get(word)
+        if word_id is None and self._base_size:
+            word_id = self._find(word)
+            if word_id is not None:
+                self._ids[word] = word_id
+        return word_id
+
+    def intern(self, word):
+        word_id = self.get(word)
+        if word_id is None:
+            word_id = len(self)
+            self._new.append(word)
+            self._ids[word] = word_id
+        return word_id
+
+    def _find(self, word):
+        key = word.encode('utf-8')
+        table, index = self._table, self._index
+        lo, hi = 0, len(index)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if table.raw(index[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(index) and table.raw(index[lo]) == key:
+            return index[lo]
+        return None
+
+    def encoded(self):
+        """Слова в порядке id в виде UTF-8 (слова снимка не декодируются)."""
+        for word_id in range(self._base_size):
+            yield self._table.raw(word_id)
+        for word in self._new:
+            yield word.encode('utf-8')
+
+    def approx_size(self):
+        # Слова снимка остаются в отображенном файле
+        return 160 * (len(self._new) + len(self._ids)) + 8 * self._base_size
+
+# Компактное хранилище переходов между словами
+class TransitionStore:
+    """Словарь токенов с целочисленными id и переходы в упакованных массивах.
+
+    Переход хранится одним 64-битным числом (id следующего слова << 32) | частота.
+    Основная часть переходов лежит в CSR-структуре: общий массив _base, где
+    переходы слова word_id занимают отрезок _offsets[word_id]:_offsets[word_id + 1],
+    отсортированный по id. Новые переходы копятся в небольших массивах _extra
+    и периодически вливаются в _base. После загрузки двоичного снимка _base и
+    _offsets - memoryview над отображенным файлом (копирование при записи).
+
+    Переходы, удаленные при прореживании, остаются в _base с нулевой частотой
+    до следующего слияния; строки с такими переходами всегда есть в _extra
+    (хотя бы пустым массивом), поэтому слияние их переписывает.
+    """
+    COUNT_MASK = 0xFFFFFFFF
+    TOP_K = 5  # Размер кэша самых частых переходов для генерации
+    TOP_CACHE_SIZE = 50000  # Сколько слов держать в кэше
+
+    def __init__(self, words=None, base=None, offsets=None):
+        self.words = words if words is not None else Vocabulary()
+        self._base = base if base is not None else array('Q')
+        self._offsets = offsets if offsets is not None else array('Q', [0])
+        self._extra = {}  # id -> array('Q') переходов, еще не влитых в _base
+        self._extra_size = 0
+        self._dead = 0  # Удаленные переходы, еще лежащие в _base
+        self._empty_rows = set()  # Слова, у которых все переходы удалены прореживанием
+        # Количество слов, у которых есть переходы
+        self._row_count = sum(1 for start, end in zip(self._offsets, self._offsets[1:]) if start != end)
+        self._top = {}  # id -> [(частота, id следующего слова)] по убыванию частоты
+
+    def intern(self, word):
+        return self.words.intern(word)
+
+    def _base_range(self, word_id):
+        if word_id < len(self._offsets) - 1:
+            return self._offsets[word_id], self._offsets[word_id + 1]
+        return 0, 0
+
+    def add(self, word, next_word, count=1):
+        word_id = self.intern(word)
+        next_id = self.intern(next_word)
+        if word_id in self._empty_rows:
+            self._empty_rows.discard(word_id)
+            self._row_count += 1
+        key = next_id << 32
+        start, end = self._base_range(word_id)
+        pos = bisect.bisect_left(self._base, key, start, end)
+        if pos < end and self._base[pos] >> 32 == next_id:
+            if not self._base[pos] & self.COUNT_MASK:
+                self._dead -= 1
+            self._base[pos] += count
+            self._update_top(word_id, next_id, self._base[pos] & self.COUNT_MASK)
+            return
+        row = self._extra.get(word_id)
+        if row is None:
+            if start == end:
+                self._row_count += 1
+            self._extra[word_id] = array('Q', [key | count])
+        else:
+            pos = bisect.bisect_left(row, key)
+            if pos < len(row) and row[pos] >> 32 == next_id:
+                row[pos] += count
+                self._update_top(word_id, next_id, row[pos] & self.COUNT_MASK)
+                return
+            row.insert(pos, key | count)
+        self._update_top(word_id, next_id, count)
+        self._extra_size += 1
+        # Слияние раз в несколько тысяч новых переходов дает амортизированное O(1)
+        if self._extra_size > max(4096, len(self._base) // 4):
+            self.compact()
+
+    def _update_top(self, word_id, next_id, count):
+        """Поддерживает кэш самых частых переходов после увеличения частоты.
+
+        Между проходами затухания (decay сбрасывает кэш строки) частоты только
+        растут, поэтому в топ может попасть лишь обновленный переход.
+        """
+        top = self._top.get(word_id)
+        if top is None:
+            return
+        for i, (_, top_id) in enumerate(top):
+            if top_id == next_id:
+                top[i] = (count, next_id)
+                break
+        else:
+            if len(top) < self.TOP_K:
+                top.append((count, next_id))
+            elif count > top[-1][0]:
+                top[-1] = (count, next_id)
+            else:
+                return
+        top.sort(key=lambda item: -item[0])
+
+    def top(self, word):
+        """Возвращает до TOP_K самых частых переходов слова [(слово, частота)]."""
+        word_id = self.words.get(word)
+        if word_id is None:
+            return []
+        top = self._top.get(word_id)
+        if top is None:
+            mask = self.COUNT_MASK
+            top = [(item & mask, item >> 32)
+                   for item in heapq.nlargest(self.TOP_K, self._row(word), key=lambda item: item & mask)]
+            if len(self._top) >= self.TOP_CACHE_SIZE:
+                # Вытесняем самую старую запись кэша
+                del self._top[next(iter(self._top))]
+            self._top[word_id] = top
+        return [(self.words[next_id], count) for count, next_id in top]
+
+    def set_row(self, word, counts):
+        """Добавляет переходы слова из словаря (используется при загрузке)."""
+        for next_word, count in counts.items():
+            if count > 0:
+                self.add(word, next_word, count)
+
+    def compact(self):
+        """Вливает накопленные новые переходы в CSR-массив."""
+        if not self._extra:
+            return
+        base, offsets, extra = self._base, self._offsets, self._extra
+        base_rows = len(offsets) - 1
+        new_base = array('Q')
+        new_offsets = array('Q', [0])
+        pos = 0
+        for word_id in sorted(extra) + [len(self.words)]:
+            # Неизмененные строки [pos, word_id) копируются одним куском
+            run_end = min(word_id, base_rows)
+            if pos < run_end:
+                start = offsets[pos]
+                shift = len(new_base) - start
+                new_base.frombytes(memoryview(base)[start:offsets[run_end]].cast('B'))
+                new_offsets.extend(offsets[row] + shift for row in range(pos + 1, run_end + 1))
+            # Слова без переходов, появившиеся после прошлого слияния
+            new_offsets.extend([len(new_base)] * (word_id - max(pos, run_end)))
+            if word_id == len(self.words):
+                break
+            start, end = self._base_range(word_id)
+            live = [item for item in base[start:end].tolist() if item & self.COUNT_MASK]
+            new_base.extend(sorted(live + extra[word_id].tolist()))
+            new_offsets.append(len(new_base))
+            pos = word_id + 1
+        self._base, self._offsets = new_base, new_offsets
+        self._extra = {}
+        self._extra_size = 0
+        self._dead = 0
+        self._empty_rows = set()
+
+    def decay(self, words, factor, min_count=1, salt=0):
+        """Умножает частоты переходов слов words на factor и удаляет переходы реже min_count.
+
+        Дробная часть округляется вверх с вероятностью, равной ей самой; случайность
+        берется из crc32 слов и salt, поэтому повтор операции из журнала дает тот же
+        результат. Возвращает количество удаленных переходов.
+        """
+        mask = self.COUNT_MASK
+        removed = 0
+        for word in words:
+            word_id = self.words.get(word)
+            if word_id is None or not self._has_row(word_id):
+                continue
+            seed = zlib.crc32(f"{salt}:{word}:".encode('utf-8'))
+
+            def decayed(item):
+                scaled = (item & mask) * factor
+                count = int(scaled)
+                if zlib.crc32(self.words.raw(item >> 32), seed) < (scaled - count) * 2 ** 32:
+                    count += 1
+                return count
+
+            live = 0
+            has_dead = False
+            start, end = self._base_range(word_id)
+            for pos in range(start, end):
+                item = self._base[pos]
+                if not item & mask:
+                    continue
+                count = decayed(item)
+                if count < min_count:
+                    self._base[pos] = item & ~mask
+                    self._dead += 1
+                    removed += 1
+                    has_dead = True
+                else:
+                    self._base[pos] = item & ~mask | count
+                    live += 1
+            row = self._extra.get(word_id)
+            if row is not None:
+                kept = array('Q')
+                for item in row:
+                    count = decayed(item)
+                    if count >= min_count:
+                        kept.append(item & ~mask | count)
+                removed += len(row) - len(kept)
+                self._extra_size -= len(row) - len(kept)
+                self._extra[word_id] = kept
+                live += len(kept)
+            elif has_dead:
+                # Строка с удаленными переходами перепишется при слиянии
+                self._extra[word_id] = array('Q')
+            if not live:
+                self._empty_rows.add(word_id)
+                self._row_count -= 1
+            # Частоты уменьшились, кэш самых частых переходов строки больше не верен
+            self._top.pop(word_id, None)
+        if self._dead > max(4096, len(self._base) // 4):
+            self.compact()
+        return removed
+
+    def transition_count(self):
+        return len(self._base) - self._dead + self._extra_size
+
+    def without_unused_words(self):
+        """Возвращает хранилище без слов, которые не участвуют ни в одном переходе.
+
+        Нужно после прореживания: удаленные переходы оставляют в словаре слова,
+        на которые больше ничто не ссылается. Если таких мало, возвращает self.
+        """
+        base, offsets = self.arrays()
+        used = bytearray(len(self.words))
+        for word_id in range(len(offsets) - 1):
+            if offsets[word_id] != offsets[word_id + 1]:
+                used[word_id] = 1
+        for item in base:
+            used[item >> 32] = 1
+        if used.count(0) * 4 < len(used):
+            return self
+        words = Vocabulary()
+        new_ids = array('Q', bytes(8 * len(used)))
+        for word_id, flag in enumerate(used):
+            if flag:
+                new_ids[word_id] = words.intern(self.words[word_id])
+        new_base = array('Q')
+        new_offsets = array('Q', [0])
+        for word_id, flag in enumerate(used):
+            if not flag:
+                continue
+            start, end = self._base_range(word_id)
+            new_base.extend(sorted(new_ids[item >> 32] << 32 | item & self.COUNT_MASK
+                                   for item in base[start:end]))
+            new_offsets.append(len(new_base))
+        return TransitionStore(words, new_base, new_offsets)
+
+    def arrays(self):
+        """Возвращает (_base, _offsets) после слияния новых переходов (для записи снимка)."""
+        self.compact()
+        return self._base, self._offsets
+
+    def _row(self, word):
+        """Возвращает упакованные переходы слова в порядке возрастания id."""
+        word_id = self.words.get(word)
+        if word_id is None:
+            return []
+        start, end = self._base_range(word_id)
+        row = self._base[start:end]
+        extra = self._extra.get(word_id)
+        if extra is not None:
+            # Удаленные переходы бывают только в строках из _extra
+            row = sorted([item for item in row.tolist() if item & self.COUNT_MASK] + extra.tolist())
+        return row
+
+    def _has_row(self, word_id):
+        if word_id in self._empty_rows:
+            return False
+        start, end = self._base_range(word_id)
+        return start != end or word_id in self._extra
+
+    def __contains__(self, word):
+        word_id = self.words.get(word)
+        return word_id is not None and self._has_row(word_id)
+
+    def row_words(self, start, end):
+        """Слова с id из [start, end), у которых есть переходы."""
+        return [self.words[word_id] for word_id in range(start, end) if self._has_row(word_id)]
+
+    def __len__(self):
+        return self._row_count
+
+    def successors(self, word):
+        """Возвращает словарь {следующее слово: частота}."""
+        words, mask = self.words, self.COUNT_MASK
+        return {words[item >> 32]: item & mask for item in self._row(word)}
+
+    def most_common(self, word, n):
+        mask = self.COUNT_MASK
+        top = heapq.nlargest(n, self._row(word), key=lambda item: item & mask)
+        return [(self.words[item >> 32], item & mask) for item in top]
+
+    def approx_size(self):
+        """Грубая оценка занимаемой памяти в байтах."""
+        extra = sum(len(row) for row in self._extra.values())
+        # ~60 байт на строку слова и ~100 байт на запись в словаре id
+        return 8 * (len(self._base) + len(self._offsets) + extra) + self.words.approx_size()
+
+    def items(self):
+        for word in self.words:
+            if word in self:
+                yield word, self.successors(word)
+
+# Ограниченное множество сообщений с быстрым случайным выбором
+class BoundedSampleSet:
+    """Упорядоченное множество с проверкой вхождения и случайным выбором за O(1).
+
+    При превышении capacity вытесняется самый старый элемент ('fifo') или
+    тот, который дольше всех не встречался ('lru'). Поддерживает len() и
+    индексацию, поэтому random.choice работает с ним напрямую.
+    """
+    def __init__(self, items=(), capacity=None, policy='fifo'):
+        if policy not in ('fifo', 'lru'):
+            raise ValueError(f"Неизвестная политика вытеснения: {policy}")
+        self.capacity = capacity
+        self.policy = policy
+        # callback(item) для новых и вытесненных элементов (например, для поискового индекса)
+        self.on_add = None
+        self.on_evict = None
+        self._order = OrderedDict()  # элемент -> позиция в _items, порядок вытеснения
+        self._items = []  # Плотный список для равномерного выбора
+        self.extend(items)
+
+    def append(self, item):
+        """Добавляет элемент; возвращает True, если его еще не было."""
+        if item in self._order:
+            if self.policy == 'lru':
+                self._order.move_to_end(item)
+            return False
+        self._order[item] = len(self._items)
+        self._items.append(item)
+        if self.on_add is not None:
+            self.on_add(item)
+        if self.capacity is not None:
+            while len(self._items) > self.capacity:
+                evicted = next(iter(self._order))
+                self._remove(evicted)
+                if self.on_evict is not None:
+                    self.on_evict(evicted)
+        return True
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def _remove(self, item):
+        # Последний элемент переносится на место удаленного, чтобы список оставался плотным
+        pos = self._order.pop(item)
+        last = self._items.pop()
+        if pos < len(self._items):
+            self._items[pos] = last
+            self._order[last] = pos
+
+    def __contains__(self, item):
+        return item in self._order
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        return self._items[index]
+
+    def __iter__(self):
+        # Порядок добавления (для сохранения)
+        return iter(self._order)
+
+# Поиск приветствия в начале сообщения
+class GreetingMatcher:
+    """Префиксное дерево приветствий; находит самое длинное совпадение за один проход."""
+    def __init__(self, greetings=()):
+        self.root = {}
+        for greeting in greetings:
+            node = self.root
+            for char in greeting:
+                node = node.setdefault(char, {})
+            node[None] = greeting  # Конец приветствия
+
+    def match(self, message):
+        """Возвращает самое длинное приветствие, с которого начинается сообщение, или None."""
+        node = self.root
+        found = node.get(None)
+        for char in message:
+            node = node.get(char)
+            if node is None:
+                break
+            found = node.get(None, found)
+        return found
+
+# Двоичный снимок модели
+class ModelSnapshot:
+    """Снимок модели, который открывается через mmap и читается по требованию.
+
+    Заголовок: сигнатура, версия формата, флаги, номер последней записи журнала
+    и число секций; за ним каталог секций (имя, смещение, длина). Секции
+    выровнены по 8 байт: словарь (StringTable) и его индекс сортировки,
+    CSR-массивы переходов, паттерны, ответы по ключам и приветствия.
+    Незнакомые секции при чтении пропускаются, поэтому новые секции можно
+    добавлять без смены версии; VERSION меняется только при несовместимых
+    изменениях.
+    """
+    MAGIC = b'HLBM'
+    VERSION = 1
+    BIG_ENDIAN = 1  # Флаг: массивы записаны в порядке байтов big-endian
+    HEADER = struct.Struct('<4sHHQI4x')  # Сигнатура, версия, флаги, journal_seq, число секций
+    SECTION = struct.Struct('<8sQQ')  # Имя, смещение, длина
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            if os.name == 'nt':
+                # В Windows отображенный файл нельзя заменить при сворачивании журнала
+                buffer = bytearray(f.read())
+            else:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        view = memoryview(buffer)
+        magic, version, flags, self.journal_seq, count = self.HEADER.unpack_from(view, 0)
+        if magic != self.MAGIC:
+            raise ValueError(f"{path} не является снимком модели")
+        if version > self.VERSION:
+            raise ValueError(f"Снимок {path} записан более новой версией формата ({version})")
+        if bool(flags & self.BIG_ENDIAN) != (sys.byteorder == 'big'):
+            raise ValueError(f"Снимок {path} записан с другим порядком байтов")
+        self.sections = {}
+        for i in range(count):
+            name, offset, length = self.SECTION.unpack_from(view, self.HEADER.size + i * self.SECTION.size)
+            self.sections[name.rstrip(b'\0').decode('ascii')] = view[offset:offset + length]
+
+    def strings(self, name):
+        return StringTable(self.sections[name])
+
+    def array(self, name):
+        return self.sections[name].cast('Q')
+
+    def load(self):
+        """Возвращает данные модели в том же виде, что и ModelJournal.read."""
+        words = Vocabulary(self.strings('words'), self.array('wordidx'))
+        store = TransitionStore(words, self.array('base'), self.array('offsets'))
+        keys, bounds, items = self.strings('respkeys'), self.array('respoffs'), self.strings('resps')
+        responses = {key: [items[i] for i in range(bounds[k], bounds[k + 1])] for k, key in enumerate(keys)}
+        return {
+            'word_associations': store,
+            'message_patterns': list(self.strings('patterns')),
+            'responses': responses,
+            'greetings': list(self.strings('greets')),
+            'journal_seq': self.journal_seq,
+        }
+
+    @classmethod
+    def write(cls, path, data):
+        base, offsets = data['word_associations'].arrays()
+        words = list(data['word_associations'].words.encoded())
+        index = array('Q', sorted(range(len(words)), key=words.__getitem__))
+        responses = data['responses']
+        bounds = array('Q', [0])
+        items = []
+        for bucket in responses.values():
+            items.extend(message.encode('utf-8') for message in bucket)
+            bounds.append(len(items))
+
+        def encode(strings):
+            return StringTable.pack(item.encode('utf-8') for item in strings)
+
+        sections = [
+            (b'words', StringTable.pack(words)),
+            (b'wordidx', index),
+            (b'offsets', offsets),
+            (b'base', base),
+            (b'patterns', encode(data['message_patterns'])),
+            (b'respkeys', encode(responses)),
+            (b'respoffs', bounds),
+            (b'resps', StringTable.pack(items)),
+            (b'greets', encode(data.get('greetings', []))),
+        ]
+        flags = cls.BIG_ENDIAN if sys.byteorder == 'big' else 0
+        offset = cls.HEADER.size + cls.SECTION.size * len(sections)
+        directory = []
+        for name, payload in sections:
+            offset += -offset % 8
+            length = memoryview(payload).nbytes
+            directory.append(cls.SECTION.pack(name, offset, length))
+            offset += length
+        with open(path, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, flags, data.get('journal_seq', 0), len(sections)))
+            for entry in directory:
+                f.write(entry)
+            for name, payload in sections:
+                f.write(b'\0' * (-f.tell() % 8))
+                f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+
+# Журнал изменений модели с отложенной записью
+class ModelJournal:
+    """Дописывает дельты модели в журнал в фоновом потоке и периодически сворачивает его в снимок."""
+    def __init__(self, data_file, compact_every=500, pattern_limit=5000, response_limit=None, policy='fifo',
+                 read_only=False):
+        self.data_file = data_file  # Снимок в старом формате JSON, только для чтения
+        self.read_only = read_only  # Модель пишет другой процесс, журнал здесь только читается
+        self.snapshot_file = os.path.splitext(data_file)[0] + '.bin'
+        self.journal_file = data_file + '.journal'
+        self.compacting_file = data_file + '.journal.compacting'
+        self.compact_every = compact_every  # Количество записей журнала до сворачивания в снимок
+        self.pattern_limit = pattern_limit
+        self.response_limit = response_limit
+        self.policy = policy
+        self.greetings = []
+        self.seq = 0
+        self._records = 0
+        # Один поток гарантирует порядок записей и сворачиваний
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='model-journal')
+
+    @staticmethod
+    def new_delta():
+        return {'t': {}, 'p': [], 'r': {}}
+
+    @staticmethod
+    def is_empty(delta):
+        return not (delta['t'] or delta['p'] or delta['r'])
+
+    def new_patterns(self, items=()):
+        return BoundedSampleSet(items, self.pattern_limit, self.policy)
+
+    def new_bucket(self, items=()):
+        return BoundedSampleSet(items, self.response_limit, self.policy)
+
+    def merge_delta(self, data, delta):
+        """Применяет дельту журнала к данным, прочитанным из снимка."""
+        associations = data['word_associations']
+        for word, counts in delta.get('t', {}).items():
+            associations.set_row(word, counts)
+
+        decay = delta.get('d')
+        if decay:
+            associations.decay(decay['w'], decay['f'], decay['m'], decay['e'])
+            data['pruned'] = True
+
+        data['message_patterns'].extend(delta.get('p', []))
+
+        responses = data['responses']
+        for key, items in delta.get('r', {}).items():
+            if key not in responses:
+                responses[key] = self.new_bucket()
+            responses[key].extend(items)
+
+    def read(self, include_journal=True):
+        """Читает снимок и воспроизводит поверх него незавершенные записи журнала."""
+        data = {}
+        if os.path.exists(self.snapshot_file):
+            data = ModelSnapshot(self.snapshot_file).load()
+        elif os.path.exists(self.data_file):
+            # Старый формат: счетчики переходов словарями в JSON
+            with open(self.data_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            store = TransitionStore()
+            for word, counts in data.get('word_associations', {}).items():
+                store.set_row(word, counts)
+            data['word_associations'] = store
+        if 'word_associations' not in data:
+            data['word_associations'] = TransitionStore()
+        # Списки сразу переводим в ограниченные множества, как при обучении
+        data['message_patterns'] = self.new_patterns(data.get('message_patterns', []))
+        data['responses'] = {key: self.new_bucket(items) for key, items in data.get('responses', {}).items()}
+        last_seq = data.get('journal_seq', 0)
+        paths = [self.compacting_file]
+        if include_journal:
+            paths.append(self.journal_file)
+        for path in paths:
+            for seq, delta in self._read_journal(path):
+                # Записи, уже вошедшие в снимок, пропускаем (сбой во время сворачивания)
+                if seq <= last_seq:
+                    continue
+                self.merge_delta(data, delta)
+                last_seq = seq
+        data['journal_seq'] = last_seq
+        return data
+
+    def _read_journal(self, path):
+        if not os.path.exists(path):
+            return
+        with open(path, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Оборванная последняя строка после аварийного завершения
+                    logger.warning(f"Пропущена поврежденная запись журнала {path}:{line_number}")
+                    break
+                yield record.pop('seq'), record
+
+    def append(self, delta):
+        """Ставит дельту в очередь на запись, не блокируя вызывающий поток."""
+        if self.read_only:
+            return None
+        self.seq += 1
+        return self._executor.submit(self._write, self.seq, delta)
+
+    def _write(self, seq, delta):
+        try:
+            record = dict(delta, seq=seq)
+            with open(self.journal_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._records += 1
+            if self._records >= self.compact_every:
+                self._compact()
+        except Exception as e:
+            logger.error(f"Ошибка при записи журнала {self.journal_file}: {e}")
+
+    def compact(self, force=False):
+        """Ставит в очередь сворачивание журнала в снимок (force - даже без новых записей)."""
+        return self._executor.submit(self._compact, force)
+
+    def _compact(self, force=False):
+        if self.read_only:
+            return False
+        try:
+            # Если прошлое сворачивание прервалось, сначала доводим его до конца
+            if not os.path.exists(self.compacting_file):
+                if os.path.exists(self.journal_file):
+                    os.replace(self.journal_file, self.compacting_file)
+                elif not force:
+                    return
+            data = self.read(include_journal=False)
+            if self.greetings:
+                data['greetings'] = self.greetings
+            if data.pop('pruned', False):
+                # После прореживания в словаре остаются слова без переходов
+                data['word_associations'] = data['word_associations'].without_unused_words()
+            tmp_file = self.snapshot_file + '.tmp'
+            ModelSnapshot.write(tmp_file, data)
+            os.replace(tmp_file, self.snapshot_file)
+            if os.path.exists(self.compacting_file):
+                os.remove(self.compacting_file)
+            self._records = 0
+            logger.info(f"Журнал свернут в снимок {self.snapshot_file}")
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при сворачивании журнала {self.journal_file}: {e}")
+            return False
+
+    def snapshot_version(self):
+        """Время изменения снимка; по нему читатели замечают, что снимок обновили."""
+        try:
+            return os.stat(self.snapshot_file).st_mtime_ns
+        except OSError:
+            return 0
+
+    def close(self):
+        """Дожидается записи всех дельт и сворачивает журнал."""
+        self._executor.submit(self._compact)
+        self._executor.shutdown(wait=True)
+
+# Поиск сохраненных сообщений, похожих на входящее
+class RetrievalIndex:
+    """Индекс сообщений по хешированным словам и парам слов с весами TF-IDF.
+
+    Документ - вектор частот признаков, нормированный по длине; IDF
+    применяется к запросу, поэтому добавление и удаление документов не
+    требует пересчета уже проиндексированных. С numpy признаки лежат в
+    плоских массивах (документ, признак, вес): начало массивов отсортировано
+    по признаку, и запрос читает только отрезки своих признаков, а недавно
+    добавленный хвост просматривается целиком и периодически вливается в
+    отсортированную часть. Без numpy используется обратный индекс.
+    Удаленные документы помечаются и вычищаются, когда их становится много.
+    """
+    DIMENSIONS = 1 << 20  # Количество корзин хеширования признаков
+
+    def __init__(self, tokenizer, min_score=0.2):
+        load_numpy()
+        self.tokenizer = tokenizer
+        self.min_score = min_score  # Ниже этой косинусной близости кандидаты отбрасываются
+        self._slots = {}  # текст -> номер документа
+        self._texts = []  # номер документа -> текст, None для удаленных
+        self._refs = {}  # текст -> в скольких коллекциях модели он хранится
+        self._count = 0  # Живые документы
+        # Документная частота только для встречающихся корзин: плотный массив на 2^20
+        # корзин занимал бы мегабайты в каждой модели чата
+        self._df = {}
+        if np is not None:
+            self._rows = np.empty(1024, np.int32)
+            self._cols = np.empty(1024, np.int32)
+            self._vals = np.empty(1024, np.float32)
+            self._alive = np.zeros(1024, bool)
+            self._nnz = 0
+            self._sorted = 0  # Первые _sorted признаков отсортированы по номеру корзины
+            self._dead_nnz = 0
+        else:
+            self._postings = defaultdict(dict)  # корзина -> {номер документа: вес}
+
+    def __len__(self):
+        return self._count
+
+    def _features(self, text):
+        """Частоты хешированных признаков: слова и пары соседних слов."""
+        tokens = self.tokenizer.tokenize(text.lower())
+        counts = {}
+        mask = self.DIMENSIONS - 1
+        for feature in itertools.chain(tokens, map(' '.join, zip(tokens, tokens[1:]))):
+            bucket = zlib.crc32(feature.encode('utf-8')) & mask
+            counts[bucket] = counts.get(bucket, 0) + 1
+        return counts
+
+    def add(self, text):
+        refs = self._refs.get(text, 0)
+        self._refs[text] = refs + 1
+        if refs:
+            return
+        counts = self._features(text)
+        if not counts:
+            return
+        norm = math.sqrt(sum(count * count for count in counts.values()))
+        slot = len(self._texts)
+        self._slots[text] = slot
+        self._texts.append(text)
+        self._count += 1
+        df = self._df
+        for bucket in counts:
+            df[bucket] = df.get(bucket, 0) + 1
+        if np is None:
+            for bucket, count in counts.items():
+                self._postings[bucket][slot] = count / norm
+            return
+        buckets = np.fromiter(counts, np.int32, len(counts))
+        weights = np.fromiter(counts.values(), np.float32, len(counts)) / norm
+        end = self._nnz + len(counts)
+        if end > len(self._rows):
+            capacity = max(2 * len(self._rows), end)
+            for name in ('_rows', '_cols', '_vals'):
+                array_ = getattr(self, name)
+                grown = np.empty(capacity, array_.dtype)
+                grown[:self._nnz] = array_[:self._nnz]
+                setattr(self, name, grown)
+        self._rows[self._nnz:end] = slot
+        self._cols[self._nnz:end] = buckets
+        self._vals[self._nnz:end] = weights
+        self._nnz = end
+        if slot >= len(self._alive):
+            self._alive = np.concatenate([self._alive, np.zeros(len(self._alive), bool)])
+        self._alive[slot] = True
+        if self._nnz - self._sorted > max(65536, self._sorted // 8):
+            self._merge()
+
+    def _merge(self):
+        """Вливает хвост недавно добавленных признаков в отсортированную часть."""
+        n = self._nnz
+        order = np.argsort(self._cols[:n], kind='stable')
+        self._rows[:n] = self._rows[:n][order]
+        self._cols[:n] = self._cols[:n][order]
+        self._vals[:n] = self._vals[:n][order]
+        self._sorted = n
+
+    def discard(self, text):
+        refs = self._refs.get(text, 0) - 1
+        if refs > 0:
+            self._refs[text] = refs
+            return
+        self._refs.pop(text, None)
+        slot = self._slots.pop(text, None)
+        if slot is None:
+            return
+        self._texts[slot] = None
+        self._count -= 1
+        counts = self._features(text)
+        df = self._df
+        for bucket in counts:
+            if df[bucket] > 1:
+                df[bucket] -= 1
+            else:
+                del df[bucket]
+        if np is None:
+            for bucket in counts:
+                postings = self._postings[bucket]
+                del postings[slot]
+                if not postings:
+                    del self._postings[bucket]
+            return
+        self._alive[slot] = False
+        self._dead_nnz += len(counts)
+        if self._dead_nnz > max(65536, self._nnz // 2):
+            self._vacuum()
+
+    def _vacuum(self):
+        """Удаляет признаки удаленных документов и перенумеровывает оставшиеся."""
+        slots = len(self._texts)
+        alive = self._alive[:slots]
+        keep = alive[self._rows[:self._nnz]]
+        self._sorted = int(np.count_nonzero(keep[:self._sorted]))
+        new_slots = np.cumsum(alive, dtype=np.int32) - 1
+        self._rows = new_slots[self._rows[:self._nnz][keep]]
+        self._cols = self._cols[:self._nnz][keep]
+        self._vals = self._vals[:self._nnz][keep]
+        self._nnz = len(self._rows)
+        self._dead_nnz = 0
+        self._texts = [text for text in self._texts if text is not None]
+        self._slots = {text: slot for slot, text in enumerate(self._texts)}
+        self._alive = np.ones(max(1024, len(self._texts)), bool)
+        self._alive[len(self._texts):] = False
+
+    def approx_size(self):
+        """Грубая оценка памяти индекса в байтах."""
+        # ~100 байт на запись словарей и ~80 байт на строку текста
+        size = 100 * (len(self._df) + 2 * len(self._slots)) + 80 * len(self._texts)
+        if np is None:
+            return size + 100 * sum(len(postings) for postings in self._postings.values())
+        return size + self._rows.nbytes + self._cols.nbytes + self._vals.nbytes + self._alive.nbytes
+
+    def search(self, query, k=5):
+        """Возвращает до k сообщений, самых похожих на query, как [(близость, текст)]."""
+        counts = self._features(query)
+        if not counts or not self._count:
+            return []
+        # Вес признака запроса - частота на IDF: редкие слова важнее частых
+        df = self._df
+        weights = {bucket: count * (math.log((self._count + 1) / (df[bucket] + 1)) + 1)
+                   for bucket, count in counts.items() if bucket in df}
+        if not weights:
+            return []
+        norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+        if np is None:
+            scores = defaultdict(float)
+            for bucket, weight in weights.items():
+                for slot, value in self._postings.get(bucket, {}).items():
+                    scores[slot] += weight / norm * value
+            best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        else:
+            buckets = np.fromiter(sorted(weights), np.int32, len(weights))
+            values = np.fromiter((weights[bucket] for bucket in buckets.tolist()), np.float32, len(weights)) / norm
+            # Отсортированная часть: отрезки признаков запроса
+            sorted_cols = self._cols[:self._sorted]
+            starts = np.searchsorted(sorted_cols, buckets, 'left')
+            ends = np.searchsorted(sorted_cols, buckets, 'right')
+            rows = [self._rows[start:end] for start, end in zip(starts, ends)]
+            contributions = [self._vals[start:end] * value for start, end, value in zip(starts, ends, values)]
+            # Хвост: признаки сопоставляются с отсортированными корзинами запроса
+            tail = slice(self._sorted, self._nnz)
+            tail_cols = self._cols[tail]
+            positions = np.minimum(np.searchsorted(buckets, tail_cols), len(buckets) - 1)
+            rows.append(self._rows[tail])
+            contributions.append(self._vals[tail] * np.where(buckets[positions] == tail_cols, values[positions], 0))
+            scores = np.bincount(np.concatenate(rows), weights=np.concatenate(contributions),
+                                 minlength=len(self._texts))
+            scores[~self._alive[:len(scores)]] = 0
+            top = np.argpartition(-scores, k)[:k] if len(scores) > k else np.arange(len(scores))
+            best = [(int(slot), float(scores[slot])) for slot in top]
+            best.sort(key=lambda item: -item[1])
+        return [(score, self._texts[slot]) for slot, score in best if score >= self.min_score]
+
+# Кэш заранее сгенерированных ответов
+class ResponseCache:
+    """Несколько готовых цепочек слов для самых частых стартовых слов.
+
+    Цепочки генерируются в простое и выдаются по одной; цепочка сбрасывается,
+    когда меняются переходы любого из ее слов. Частоты стартовых слов
+    считаются по входящим сообщениям и периодически уменьшаются вдвое.
+    """
+    def __init__(self, capacity=500, pool_size=3):
+        self.capacity = capacity  # Сколько стартовых слов держать в кэше
+        self.pool_size = pool_size  # Сколько цепочек готовить для одного слова
+        self._pools = OrderedDict()  # стартовое слово -> [цепочка], от давно использованных к недавним
+        self._chain_words = {}  # стартовое слово -> слова его цепочек
+        self._by_word = defaultdict(set)  # слово -> стартовые слова, чьи цепочки через него проходят
+        self._start_counts = defaultdict(int)
+        self.size = 0  # Всего готовых цепочек
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def record(self, words):
+        """Учитывает слова, с которых можно было начать ответ."""
+        for word in words:
+            self._start_counts[word] += 1
+        if len(self._start_counts) > 4 * self.capacity:
+            self._start_counts = defaultdict(int, {word: count // 2 for word, count in self._start_counts.items()
+                                                   if count > 1})
+
+    def take(self, start_word):
+        pool = self._pools.get(start_word)
+        if pool:
+            self.hits += 1
+            self.size -= 1
+            self._pools.move_to_end(start_word)
+            return pool.pop()
+        self.misses += 1
+        return None
+
+    def wanted(self):
+        """Самые частые стартовые слова, для которых не хватает готовых цепочек."""
+        top = heapq.nlargest(self.capacity, self._start_counts.items(), key=lambda item: item[1])
+        return [word for word, _ in top if self.missing(word)]
+
+    def missing(self, start_word):
+        return self.pool_size - len(self._pools.get(start_word, ()))
+
+    def fill(self, start_word, chains):
+        pool = self._pools.setdefault(start_word, [])
+        self._pools.move_to_end(start_word)
+        words = self._chain_words.setdefault(start_word, set())
+        for chain in chains:
+            pool.append(' '.join(chain))
+            words.update(chain)
+        self.size += len(chains)
+        for word in words:
+            self._by_word[word].add(start_word)
+        while len(self._pools) > self.capacity:
+            self._drop(next(iter(self._pools)))
+
+    def _drop(self, start_word):
+        self.size -= len(self._pools.pop(start_word))
+        for word in self._chain_words.pop(start_word, ()):
+            starts = self._by_word.get(word)
+            if starts is not None:
+                starts.discard(start_word)
+                if not starts:
+                    del self._by_word[word]
+
+    def invalidate(self, word):
+        """Сбрасывает цепочки, проходящие через слово, переходы которого изменились."""
+        starts = self._by_word.get(word)
+        if starts:
+            for start_word in list(starts):
+                self._drop(start_word)
+                self.invalidations += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
 # Класс для хранения и обучения на сообщениях
 class MessageLearner:
-    def __init__(self, data_file='message_data.json'):
+    def __init__(self, data_file='message_data.json', pattern_limit=5000, response_limit=2000, eviction_policy='fifo',
+                 tokenizer=None, retrieval=True, retrieval_min_score=0.2, response_cache_size=500,
+                 response_cache_pool=3, read_only=False, load=True):
         self.data_file = data_file
+        self.tokenizer = tokenizer or make_tokenizer()
+        # Обучение и генерация выполняются в рабочих потоках бота
+        self.lock = threading.RLock()
         self.greetings = [
             "ку", "ку бро", "привет", "хай", "здарова", "йоу", "хеллоу", "салют", 
             "здравствуйте", "приветик", "дороу", "хола", "приветствую", "здрасьте"
@@ -78,35 +1513,52 @@ class MessageLearner:
             "понятно", "ясно", "согласен", "точно", "реально", "зачет", "круто",
             "да ладно", "серьезно", "жесть", "капец", "ну и ну", "офигеть", "ого"
         ]
-        self.responses = defaultdict(list)
-        self.word_associations = defaultdict(Counter)
-        self.message_patterns = []
-        self.load_data()
+        self.journal = ModelJournal(data_file, pattern_limit=pattern_limit,
+                                    response_limit=response_limit, policy=eviction_policy, read_only=read_only)
+        # Индекс сохраненных сообщений для ответа по смыслу, когда цепочка слов не строится
+        self.retrieval = RetrievalIndex(self.tokenizer, retrieval_min_score) if retrieval else None
+        self.response_cache = ResponseCache(response_cache_size, response_cache_pool) if response_cache_size else None
+        self.responses = defaultdict(self._new_bucket)
+        self.word_associations = TransitionStore()
+        self.message_patterns = self._indexed(self.journal.new_patterns())
+        self._pending = ModelJournal.new_delta()  # Изменения, еще не переданные в журнал
+        self._decay_cursor = 0  # id слова, с которого продолжится проход затухания
+        self._decay_salt = 0
+        self._decay_boost = 0  # Надбавка к порогу прореживания при превышении бюджета
+        self.decay_credit = 0.0  # Дробная часть слов, которую затухание еще должно пройти
+        self.set_greetings(self.greetings)
+        # Версию запоминаем до чтения: снимок, обновленный во время загрузки, перечитается
+        self.snapshot_version = self.journal.snapshot_version()
+        if load:
+            self.load_data()
+        else:
+            # Без модели с диска отвечаем базовыми фразами
+            self.message_patterns.extend(self.phrases)
     
     def load_data(self):
-        if os.path.exists(self.data_file):
+        if any(os.path.exists(path) for path in (self.journal.snapshot_file, self.data_file,
+                                                 self.journal.journal_file, self.journal.compacting_file)):
             try:
-                with open(self.data_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    self.responses = defaultdict(list, data.get('responses', {}))
-                    
-                    # Преобразование счетчиков из словарей
-                    self.word_associations = defaultdict(Counter)
-                    for word, counts in data.get('word_associations', {}).items():
-                        self.word_associations[word] = Counter(counts)
-                    
-                    self.message_patterns = data.get('message_patterns', [])
-                    
-                    # Добавление пользовательских приветствий, если они есть
-                    custom_greetings = data.get('greetings', [])
-                    if custom_greetings:
-                        self.greetings.extend(custom_greetings)
-                        # Уникальные значения
-                        self.greetings = list(set(self.greetings))
-
-                    # Если данных мало, добавляем базовые фразы в паттерны
-                    if len(self.message_patterns) < 10:
-                        self.message_patterns.extend(self.phrases)
+                # Снимок вместе с воспроизведенным журналом
+                data = self.journal.read()
+                self.journal.seq = data.get('journal_seq', 0)
+                self.responses = defaultdict(self._new_bucket, {key: self._indexed(bucket)
+                                                                for key, bucket in data['responses'].items()})
+                
+                # Переходы двоичного снимка читаются из отображенного файла по мере обращения
+                self.word_associations = data['word_associations']
+                
+                self.message_patterns = self._indexed(data['message_patterns'])
+                
+                # Добавление пользовательских приветствий, если они есть
+                custom_greetings = data.get('greetings', [])
+                if custom_greetings:
+                    # Уникальные значения
+                    self.set_greetings(set(self.greetings + custom_greetings))
+
+                # Если данных мало, добавляем базовые фразы в паттерны
+                if len(self.message_patterns) < 10:
+                    self.message_patterns.extend(self.phrases)
                         
                 logger.info(f"Данные успешно загружены из {self.data_file}")
             except Exception as e:
@@ -117,66 +1569,132 @@ class MessageLearner:
             # Если файла нет, добавляем базовые фразы
             self.message_patterns.extend(self.phrases)
     
+    def _indexed(self, collection):
+        """Добавляет сообщения коллекции в индекс поиска и подписывает индекс на ее изменения."""
+        if self.retrieval is not None:
+            for message in collection:
+                self.retrieval.add(message)
+            collection.on_add = self.retrieval.add
+            collection.on_evict = self.retrieval.discard
+        return collection
+
+    def _new_bucket(self):
+        return self._indexed(self.journal.new_bucket())
+
+    def set_greetings(self, greetings):
+        """Заменяет список приветствий и перестраивает дерево для их поиска."""
+        self.greetings = list(greetings)
+        self.greeting_matcher = GreetingMatcher(self.greetings)
+        self.journal.greetings = list(self.greetings)
+    
     def save_data(self):
-        data = {
-            'responses': dict(self.responses),
-            'word_associations': {word: dict(counter) for word, counter in self.word_associations.items()},
-            'message_patterns': self.message_patterns,
-            'greetings': self.greetings
-        }
-        try:
-            with open(self.data_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=4, ensure_ascii=False)
-            logger.info(f"Данные успешно сохранены в {self.data_file}")
-        except Exception as e:
-            logger.error(f"Ошибка при сохранении данных: {e}")
+        """Передает накопленные изменения в журнал; запись идет в фоновом потоке."""
+        with self.lock:
+            if ModelJournal.is_empty(self._pending):
+                return None
+            delta, self._pending = self._pending, ModelJournal.new_delta()
+            return self.journal.append(delta)
+
+    def close(self):
+        """Сохраняет оставшиеся изменения и сворачивает журнал в снимок."""
+        self.save_data()
+        self.journal.close()
+        if not self.journal.read_only:
+            logger.info(f"Данные успешно сохранены в {self.journal.snapshot_file}")
+
+    def stale(self):
+        """Снимок на диске новее загруженного (его обновил другой процесс)."""
+        return self.journal.snapshot_version() != self.snapshot_version
     
+    def learn_batch(self, messages):
+        """Обучается на пачке сообщений под одной блокировкой."""
+        with self.lock:
+            for message in messages:
+                self.learn_from_message(message)
+
     def learn_from_message(self, message):
         if not message or len(message) < 2:
             return
-        
+        with self.lock:
+            self._learn(message)
+
+    def _learn(self, message):
         # Нормализация сообщения
         message = message.lower().strip()
         
         # Токенизация сообщения
-        try:
-            tokens = word_tokenize(message, language='russian')
-        except:
-            tokens = message.split()
+        tokens = self.tokenizer.tokenize(message)
         
         # Добавление паттерна сообщения
-        if len(message) > 3 and message not in self.message_patterns:
-            self.message_patterns.append(message)
-            # Ограничение количества хранимых паттернов
-            if len(self.message_patterns) > 5000:
-                self.message_patterns = self.message_patterns[-5000:]
+        # (количество хранимых паттернов ограничено, лишние вытесняются)
+        if len(message) > 3 and self._remember(self.message_patterns, message):
+            self._pending['p'].append(message)
         
         # Обновление ассоциаций слов
         for i in range(len(tokens) - 1):
             current_word = tokens[i]
             next_word = tokens[i + 1]
-            self.word_associations[current_word][next_word] += 1
+            self.word_associations.add(current_word, next_word)
+            dirty = self._pending['t'].setdefault(current_word, {})
+            dirty[next_word] = dirty.get(next_word, 0) + 1
+            if self.response_cache is not None:
+                self.response_cache.invalidate(current_word)
         
+        # Сохранение ответов на приветствия и по типу сообщения
+        for key, response in self.message_responses(message, self.greeting_matcher):
+            self._add_response(key, response)
+    
+    @staticmethod
+    def message_responses(message, greeting_matcher):
+        """Возвращает ответы [(ключ, текст)], которые дает нормализованное сообщение."""
+        responses = []
         # Добавление приветствий
-        for greeting in self.greetings:
-            if message.startswith(greeting) and len(message) > len(greeting) + 2:
-                response_part = message[len(greeting):].strip()
-                if response_part not in self.responses[greeting]:
-                    self.responses[greeting].append(response_part)
+        greeting = greeting_matcher.match(message)
+        if greeting and len(message) > len(greeting) + 2:
+            responses.append((greeting, message[len(greeting):].strip()))
         
-        # Определение типа сообщения и сохранение ответов
+        # Определение типа сообщения
         if '?' in message:
-            key = 'questions'
-            if message not in self.responses[key]:
-                self.responses[key].append(message)
+            responses.append(('questions', message))
         elif any(excl in message for excl in ['!', 'ого', 'вау', 'круто']):
-            key = 'exclamations'
-            if message not in self.responses[key]:
-                self.responses[key].append(message)
+            responses.append(('exclamations', message))
         else:
-            key = 'statements'
-            if message not in self.responses[key]:
-                self.responses[key].append(message)
+            responses.append(('statements', message))
+        return responses
+    
+    def learn_counts(self, transitions, patterns=(), responses=None):
+        """Вливает заранее посчитанные частоты переходов, паттерны и ответы (массовое обучение).
+
+        transitions имеет вид {слово: {следующее слово: частота}}, как в журнале.
+        """
+        with self.lock:
+            pending = self._pending['t']
+            for word, counts in transitions.items():
+                if self.response_cache is not None:
+                    self.response_cache.invalidate(word)
+                dirty = pending.setdefault(word, {})
+                for next_word, count in counts.items():
+                    self.word_associations.add(word, next_word, count)
+                    dirty[next_word] = dirty.get(next_word, 0) + count
+            for message in patterns:
+                if self._remember(self.message_patterns, message):
+                    self._pending['p'].append(message)
+            for key, items in (responses or {}).items():
+                for message in items:
+                    self._add_response(key, message)
+    
+    def _add_response(self, key, message):
+        if self._remember(self.responses[key], message):
+            self._pending['r'].setdefault(key, []).append(message)
+
+    @staticmethod
+    def _remember(collection, message):
+        """Добавляет сообщение в коллекцию; возвращает True, если это нужно записать в журнал.
+
+        При политике 'lru' повтор сообщения тоже меняет порядок вытеснения, поэтому
+        журналируется: при воспроизведении журнала он так же переносит сообщение в конец.
+        """
+        return collection.append(message) or collection.policy == 'lru'
     
     def get_greeting(self):
         return random.choice(self.greetings)
@@ -187,7 +1705,60 @@ class MessageLearner:
         else:
             return None
 
-    def generate_response(self, input_message=None):
+    def decay_step(self, max_rows, factor=0.9, min_count=1, max_transitions=0):
+        """Очередной отрезок прохода затухания: частоты слов умножаются на factor, редкие переходы удаляются.
+
+        Проход идет по словарю отрезками не больше max_rows слов, чтобы не держать
+        блокировку долго. Если переходов больше max_transitions, порог удаления
+        на следующий проход повышается. Возвращает количество удаленных переходов.
+        """
+        with self.lock:
+            store = self.word_associations
+            if self._decay_cursor == 0:
+                # Начало прохода: новая соль округления и порог с учетом бюджета
+                self._decay_salt = int(time.time())
+                total = store.transition_count()
+                if max_transitions and total > max_transitions:
+                    self._decay_boost += 1
+                elif self._decay_boost and (not max_transitions or total < 0.9 * max_transitions):
+                    self._decay_boost -= 1
+            start = self._decay_cursor
+            end = min(start + max_rows, len(store.words))
+            words = store.row_words(start, end)
+            removed = 0
+            if words:
+                # Изменения обучения должны попасть в журнал раньше операции затухания
+                self.save_data()
+                threshold = min_count + self._decay_boost
+                removed = store.decay(words, factor, threshold, self._decay_salt)
+                if self.response_cache is not None:
+                    for word in words:
+                        self.response_cache.invalidate(word)
+                self.journal.append({'d': {'w': words, 'f': factor, 'm': threshold, 'e': self._decay_salt}})
+            self._decay_cursor = 0 if end >= len(store.words) else end
+            return removed
+
+    def over_budget(self, max_transitions):
+        return bool(max_transitions) and self.word_associations.transition_count() > max_transitions
+
+    def approx_size(self):
+        """Грубая оценка памяти модели в байтах."""
+        stored = len(self.message_patterns) + sum(len(bucket) for bucket in self.responses.values())
+        size = self.word_associations.approx_size() + 200 * stored
+        if self.retrieval is not None:
+            size += self.retrieval.approx_size()
+        return size
+
+    def generate_response(self, input_message=None, fallback=None, exclude=()):
+        """Генерирует ответ; если своих данных не хватает, обращается к модели fallback.
+
+        exclude - сообщения, которые нельзя вернуть как найденный ответ
+        (например, все сообщения всплеска, из которых собран input_message).
+        """
+        with self.lock:
+            return self._generate(input_message, fallback, exclude)
+
+    def _generate(self, input_message, fallback=None, exclude=()):
         # Если сообщение не предоставлено, выберем случайное из сохраненных паттернов
         if not input_message:
             if self.message_patterns:
@@ -200,49 +1771,45 @@ class MessageLearner:
             input_message = input_message.lower().strip()
             
             # Проверка на приветствие
-            for greeting in self.greetings:
-                if input_message.startswith(greeting):
-                    response = self.get_response_to_greeting(greeting)
-                    if response:
-                        return f"{greeting} {response}"
-                    else:
-                        return greeting
+            greeting = self.greeting_matcher.match(input_message)
+            if greeting:
+                response = self.get_response_to_greeting(greeting)
+                if response:
+                    return f"{greeting} {response}"
+                else:
+                    return greeting
             
             # Генерация ответа на основе ассоциаций слов
-            try:
-                tokens = word_tokenize(input_message, language='russian')
-            except:
-                tokens = input_message.split()
+            tokens = self.tokenizer.tokenize(input_message)
                 
             if tokens:
                 # Выбираем случайное слово из сообщения, для которого у нас есть ассоциации
-                viable_words = [word for word in tokens if word in self.word_associations and self.word_associations[word]]
+                viable_words = [word for word in tokens if word in self.word_associations]
                 
                 if viable_words:
                     start_word = random.choice(viable_words)
-                    response_words = [start_word]
-                    current_word = start_word
-                    
-                    # Генерируем последовательность слов на основе вероятностей
-                    for _ in range(random.randint(3, 10)):
-                        if current_word in self.word_associations and self.word_associations[current_word]:
-                            # Выбор следующего слова на основе частотности
-                            next_word = self.word_associations[current_word].most_common(5)
-                            if next_word:
-                                if len(next_word) > 2:
-                                    words, weights = zip(*random.sample(next_word, min(len(next_word), 3)))
-                                    current_word = random.choices(words, weights=weights)[0]
-                                else:
-                                    current_word = next_word[0][0]
-                                response_words.append(current_word)
-                            else:
-                                break
-                        else:
-                            break
-                    
-                    return ' '.join(response_words)
+                    # Цепочка, заранее сгенерированная в простое, если она есть
+                    if self.response_cache is not None:
+                        self.response_cache.record(viable_words)
+                        cached = self.response_cache.take(start_word)
+                        if cached is not None:
+                            return cached
+                    return ' '.join(self._walk(start_word))
+        
+        # Если цепочка слов не построилась, ищем сохраненные сообщения на ту же тему
+        if input_message and self.retrieval is not None:
+            # Не повторяем собеседнику его же сообщения
+            excluded = {message.lower().strip() for message in exclude}
+            excluded.add(input_message)
+            candidates = [text for _, text in self.retrieval.search(input_message) if text not in excluded]
+            if candidates:
+                return random.choice(candidates)
         
-        # Если не можем сгенерировать осмысленный ответ, используем сохраненные паттерны
+        # Если не можем сгенерировать осмысленный ответ, пробуем общую модель
+        if fallback is not None:
+            return fallback.generate_response(input_message, exclude=exclude)
+        
+        # Иначе используем сохраненные паттерны
         if self.responses['statements']:
             return random.choice(self.responses['statements'])
         elif self.message_patterns:
@@ -250,6 +1817,48 @@ class MessageLearner:
         else:
             return random.choice(["ну да", "согласен", "точно", "и не говори", "бывает"])
     
+    def _walk(self, start_word):
+        """Строит цепочку слов от start_word по частотам переходов."""
+        response_words = [start_word]
+        current_word = start_word
+        
+        # Генерируем последовательность слов на основе вероятностей
+        for _ in range(random.randint(3, 10)):
+            if current_word in self.word_associations:
+                # Выбор следующего слова на основе частотности
+                next_word = self.word_associations.top(current_word)
+                if next_word:
+                    if len(next_word) > 2:
+                        words, weights = zip(*random.sample(next_word, min(len(next_word), 3)))
+                        current_word = random.choices(words, weights=weights)[0]
+                    else:
+                        current_word = next_word[0][0]
+                    response_words.append(current_word)
+                else:
+                    break
+            else:
+                break
+        return response_words
+    
+    def precompute_responses(self, max_words=20):
+        """Догенерирует цепочки для самых частых стартовых слов (вызывается в простое).
+
+        Возвращает количество пополненных слов; 0 - кэш полон.
+        """
+        if self.response_cache is None:
+            return 0
+        with self.lock:
+            filled = 0
+            for word in self.response_cache.wanted():
+                if word not in self.word_associations:
+                    continue
+                missing = self.response_cache.missing(word)
+                self.response_cache.fill(word, [self._walk(word) for _ in range(missing)])
+                filled += 1
+                if filled >= max_words:
+                    break
+            return filled
+    
     def humanize_message(self, message):
         """Делает сообщение более похожим на сообщение от человека."""
         # Проверяем, что сообщение не пустое
@@ -278,66 +1887,1280 @@ class MessageLearner:
         
         return message
 
-# Основной класс бота
-class HumanLikeBot:
-    def __init__(self):
-        self.config = BotConfig()
-        self.learner = MessageLearner()
-        self.client = None
-        self.active_chats = {}  # Для отслеживания активных диалогов
-        self.last_message_time = {}  # Для отслеживания времени последнего сообщения в чате
-        self.initialized = False
-    
-    async def initialize(self):
-        if not self.config.api_id or not self.config.api_hash:
-            logger.error("API ID или API Hash не настроены. Пожалуйста, заполните config.json")
-            return False
-        
-        # Создание клиента Telegram
-        self.client = TelegramClient(self.config.session_name, self.config.api_id, self.config.api_hash)
-        await self.client.start()
-        
-        # Проверяем доступ к чатам
-        print(f"Проверка доступа к чатам: {self.config.chat_ids}")
-        for chat_id in self.config.chat_ids:
+# Реестр моделей отдельных чатов
+class LearnerRegistry:
+    """Держит в памяти модели активных чатов.
+
+    Модель чата загружается из своего файла при первом обращении и выгружается
+    на диск, если чат простаивает дольше idle_timeout, если загружено больше
+    max_loaded моделей или их суммарный размер превышает memory_budget.
+    """
+    def __init__(self, factory, models_dir='chat_models', idle_timeout=1800, max_loaded=50, memory_budget=None):
+        self.factory = factory  # data_file -> MessageLearner
+        self.models_dir = models_dir
+        self.idle_timeout = idle_timeout
+        self.max_loaded = max_loaded
+        self.memory_budget = memory_budget  # В байтах, None - без ограничения
+        self._models = OrderedDict()  # chat_id -> MessageLearner, от давно использованных к недавним
+        self._last_used = {}
+        self._in_use = defaultdict(int)  # Модели, с которыми сейчас работают, не выгружаются
+        self._closing = set()  # Выгружаемые модели: пока журнал не дописан, заново их не читаем
+        self._loading = set()  # Модели, которые сейчас читаются с диска
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)  # Закончилась загрузка или выгрузка модели
+        os.makedirs(models_dir, exist_ok=True)
+
+    def model_file(self, chat_id):
+        return os.path.join(self.models_dir, f"{chat_id}.json")
+
+    @contextlib.contextmanager
+    def use(self, chat_id, touch=True):
+        """Выдает модель чата, загружая ее при необходимости; на время работы она не выгружается.
+
+        Фоновые задачи передают touch=False, чтобы не продлевать жизнь простаивающей модели.
+        """
+        chat_id = str(chat_id)
+        with self._lock:
+            # Иначе новая модель прочитает журнал без последних дельт старой и повторит ее номера записей;
+            # модель, которую уже читает другой поток, дожидаемся, а не читаем второй раз
+            while chat_id in self._closing or chat_id in self._loading:
+                self._changed.wait()
+            learner = self._models.get(chat_id)
+            if learner is not None:
+                self._acquire(chat_id, touch)
+            else:
+                self._loading.add(chat_id)
+        if learner is None:
+            # Модель читается без блокировки реестра: другие чаты и цикл событий ее не ждут
             try:
-                # Преобразуем ID чата в целое число
-                numeric_chat_id = int(chat_id)
-                
-                # Получаем информацию о чате
-                chat = await self.client.get_entity(numeric_chat_id)
-                print(f"Успешно получен доступ к чату: {chat.id} - {getattr(chat, 'title', 'Личный чат')}")
-                
-                # Инициализируем время последнего сообщения
-                self.last_message_time[str(chat.id)] = time.time()
-            except Exception as e:
-                print(f"Ошибка при доступе к чату {chat_id}: {e}")
-                logger.error(f"Ошибка при доступе к чату {chat_id}: {e}")
-        
-        self.initialized = True
-        logger.info("Бот успешно инициализирован и подключен к Telegram")
-        return True
-    
-    def is_bot_chat(self, chat_id):
-        """Проверяет, находится ли чат в списке отслеживаемых чатов."""
-        return str(chat_id) in [str(cid) for cid in self.config.chat_ids]
+                learner = self.factory(self.model_file(chat_id))
+            finally:
+                with self._lock:
+                    self._loading.discard(chat_id)
+                    if learner is not None:
+                        self._models[chat_id] = learner
+                        self._acquire(chat_id, touch)
+                    self._changed.notify_all()
+            logger.info(f"Загружена модель чата {chat_id}")
+        try:
+            yield learner
+        finally:
+            with self._lock:
+                self._in_use[chat_id] -= 1
+
+    def _acquire(self, chat_id, touch):
+        if touch or chat_id not in self._last_used:
+            self._models.move_to_end(chat_id)
+            self._last_used[chat_id] = time.time()
+        self._in_use[chat_id] += 1
+
+    def loaded(self):
+        with self._lock:
+            return list(self._models)
+
+    def learners(self):
+        with self._lock:
+            return list(self._models.values())
+
+    def drop_stale(self):
+        """Выгружает модели, чьи снимки обновились на диске; при следующем обращении они перечитаются."""
+        with self._lock:
+            dropped = [(chat_id, self._models.pop(chat_id)) for chat_id, learner in list(self._models.items())
+                       if not self._in_use[chat_id] and learner.stale()]
+            for chat_id, _ in dropped:
+                self._last_used.pop(chat_id, None)
+                self._closing.add(chat_id)
+        self._close(dropped)
+        return [chat_id for chat_id, _ in dropped]
+
+    def _close(self, unloaded):
+        """Закрывает выгруженные модели; до конца закрытия use() их не перечитывает."""
+        for chat_id, learner in unloaded:
+            try:
+                learner.close()
+            finally:
+                with self._lock:
+                    self._closing.discard(chat_id)
+                    self._changed.notify_all()
+
+    def save_all(self):
+        with self._lock:
+            learners = list(self._models.values())
+        for learner in learners:
+            learner.save_data()
+
+    def evict(self, now=None):
+        """Выгружает простаивающие модели и модели сверх лимитов; возвращает id выгруженных чатов."""
+        now = now or time.time()
+        evicted = []
+        with self._lock:
+            models = list(self._models.items())
+        # Размер считается под блокировкой модели (обучение меняет ее словари), но без блокировки реестра
+        sizes = {}
+        for chat_id, learner in models:
+            with learner.lock:
+                sizes[chat_id] = learner.approx_size()
+        with self._lock:
+            total = sum(sizes.get(chat_id, 0) for chat_id in self._models)
+            for chat_id in list(self._models):
+                if self._in_use[chat_id]:
+                    continue
+                over_count = len(self._models) > self.max_loaded
+                over_budget = self.memory_budget is not None and total > self.memory_budget
+                idle = now - self._last_used.get(chat_id, 0) > self.idle_timeout
+                if not (idle or over_count or over_budget):
+                    continue
+                evicted.append((chat_id, self._models.pop(chat_id)))
+                self._last_used.pop(chat_id, None)
+                self._closing.add(chat_id)
+                total -= sizes.get(chat_id, 0)
+        # Сохранение на диск идет уже без блокировки реестра
+        self._close(evicted)
+        for chat_id, _ in evicted:
+            logger.info(f"Модель чата {chat_id} выгружена на диск")
+        return [chat_id for chat_id, _ in evicted]
+
+    def close_all(self):
+        with self._lock:
+            unloaded = list(self._models.items())
+            self._models.clear()
+            self._last_used.clear()
+            self._closing.update(chat_id for chat_id, _ in unloaded)
+        self._close(unloaded)
+
+# Кэш сущностей Telegram
+class EntityCache:
+    """Кэш чатов и пользователей по id с TTL, отрицательным кэшированием и сохранением на диск.
+
+    На диск сохраняются только InputPeer (id и access_hash): их достаточно для
+    отправки сообщений и статуса "печатает" без обращения к серверу.
+    """
+    PEER_TYPES = {
+        'channel': (InputPeerChannel, 'channel_id'),
+        'chat': (InputPeerChat, 'chat_id'),
+        'user': (InputPeerUser, 'user_id'),
+    }
+
+    def __init__(self, client, cache_file='entity_cache.json', ttl=86400, negative_ttl=300):
+        self.client = client
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = {}  # peer_id -> (сущность, время истечения)
+        self._failures = {}  # peer_id -> (текст ошибки, время истечения)
+        self._inflight = {}  # (peer_id, через get_entity) -> задача, уже запрашивающая сущность
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.dirty = False
+        self.load()
+
+    async def get(self, peer_id, fetch=None):
+        """Возвращает сущность из кэша или запрашивает ее (по умолчанию через client.get_entity)."""
+        peer_id = int(peer_id)
+        now = time.time()
+        entry = self._entries.get(peer_id)
+        if entry and entry[1] > now:
+            self.hits += 1
+            return entry[0]
+        # Неудача запоминается только для get_entity: свой способ получения
+        # (например, event.get_input_chat) может сработать и тогда
+        failure = self._failures.get(peer_id)
+        if fetch is None and failure and failure[1] > now:
+            self.negative_hits += 1
+            raise ValueError(f"Сущность {peer_id} недоступна: {failure[0]}")
+        # Одновременные промахи по одному id ждут один и тот же запрос того же способа
+        key = (peer_id, fetch is None)
+        task = self._inflight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(fetch() if fetch else self.client.get_entity(peer_id))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        try:
+            with metrics.stage('entity_fetch'):
+                entity = await asyncio.shield(task)
+            if entity is None and fetch is None:
+                raise ValueError(f"Сущность {peer_id} не найдена")
+        except Exception as e:
+            if fetch is None:
+                self._failures[peer_id] = (str(e), time.time() + self.negative_ttl)
+            raise
+        if entity is None:
+            # Свой способ может не найти сущность (get_input_chat тогда возвращает None):
+            # None не кэшируем, иначе все отправки в чат падали бы до истечения ttl
+            return await self.get(peer_id)
+        self.put(peer_id, entity)
+        return entity
+
+    def put(self, peer_id, entity):
+        self._entries[int(peer_id)] = (entity, time.time() + self.ttl)
+        self._failures.pop(int(peer_id), None)
+        self.dirty = True
+
+    def invalidate(self, peer_id):
+        self._entries.pop(int(peer_id), None)
+        self._failures.pop(int(peer_id), None)
+        self.dirty = True
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.negative_hits
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'negative_hits': self.negative_hits,
+            'hit_rate': (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+        }
+
+    def _serialize(self, entity):
+        try:
+            peer = utils.get_input_peer(entity)
+        except TypeError:
+            return None
+        for peer_type, (cls, id_field) in self.PEER_TYPES.items():
+            if isinstance(peer, cls):
+                return {'type': peer_type, 'id': getattr(peer, id_field),
+                        'access_hash': getattr(peer, 'access_hash', None)}
+        return None
+
+    def _deserialize(self, record):
+        cls, id_field = self.PEER_TYPES[record['type']]
+        kwargs = {id_field: record['id']}
+        if record.get('access_hash') is not None:
+            kwargs['access_hash'] = record['access_hash']
+        return cls(**kwargs)
+
+    def load(self):
+        if not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                records = json.load(f)
+            now = time.time()
+            for peer_id, record in records.items():
+                if record['expires'] > now:
+                    self._entries[int(peer_id)] = (self._deserialize(record), record['expires'])
+            logger.info(f"Загружено {len(self._entries)} сущностей из {self.cache_file}")
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке кэша сущностей: {e}")
+
+    def save(self):
+        records = {}
+        for peer_id, (entity, expires) in list(self._entries.items()):
+            record = self._serialize(entity)
+            if record:
+                record['expires'] = expires
+                records[str(peer_id)] = record
+        self.dirty = False
+        try:
+            tmp_file = self.cache_file + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(records, f)
+            os.replace(tmp_file, self.cache_file)
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении кэша сущностей: {e}")
+
+# Позиции чтения чатов
+class ChatCursors:
+    """Id последнего изученного сообщения каждого чата с сохранением на диск.
+
+    Пока чат догружает пропущенное, живые сообщения не двигают его позицию, а
+    запоминаются: при догрузке они пропускаются, а после нее позиция
+    переходит за них. Без cursor_file позиции хранятся только в памяти
+    (обработчик режима --supervisor передает их супервизору).
+    """
+    def __init__(self, cursor_file='chat_cursors.json'):
+        self.cursor_file = cursor_file
+        self._ids = {}  # chat_id -> id последнего изученного сообщения
+        self._held = {}  # chat_id -> id сообщений, пришедших вживую во время догрузки
+        self._changed = {}  # Позиции, сдвинувшиеся после последнего changes()
+        self.dirty = False
+        self.load()
+
+    def get(self, chat_id):
+        return self._ids.get(str(chat_id))
+
+    def advance(self, chat_id, message_id):
+        chat_id = str(chat_id)
+        held = self._held.get(chat_id)
+        if held is not None:
+            held.add(message_id)
+        elif message_id > self._ids.get(chat_id, 0):
+            self._move(chat_id, message_id)
+
+    def hold(self, chat_id):
+        """Замораживает позицию чата до конца догрузки."""
+        self._held.setdefault(str(chat_id), set())
+
+    def seen(self, chat_id, message_id):
+        return message_id in self._held.get(str(chat_id), ())
+
+    def release(self, chat_id, until, complete=True, keep_hold=False):
+        """Пропуск изучен до сообщения until; снимает заморозку, если keep_hold не задан.
+
+        Если пропуск изучен целиком, позиция переходит и за сообщения, пришедшие вживую.
+        """
+        chat_id = str(chat_id)
+        held = self._held.get(chat_id, set()) if keep_hold else self._held.pop(chat_id, set())
+        if complete:
+            until = max([until, *held])
+        if until > self._ids.get(chat_id, 0):
+            self._move(chat_id, until)
+
+    def _move(self, chat_id, message_id):
+        self._ids[chat_id] = message_id
+        self._changed[chat_id] = message_id
+        self.dirty = True
+
+    def changes(self):
+        """Возвращает позиции, сдвинувшиеся после прошлого вызова."""
+        changes, self._changed = self._changed, {}
+        return changes
+
+    def merge(self, ids):
+        """Принимает чужие позиции (например, от супервизора), если они дальше своих."""
+        for chat_id, message_id in ids.items():
+            if message_id > self._ids.get(str(chat_id), 0):
+                self._ids[str(chat_id)] = message_id
+
+    def snapshot(self):
+        return dict(self._ids)
+
+    def load(self):
+        if self.cursor_file is None or not os.path.exists(self.cursor_file):
+            return
+        try:
+            with open(self.cursor_file, 'r', encoding='utf-8') as f:
+                self._ids = json.load(f)
+            logger.info(f"Загружены позиции {len(self._ids)} чатов из {self.cursor_file}")
+        except Exception as e:
+            logger.error(f"Ошибка при загрузке позиций чатов: {e}")
+
+    def save(self):
+        records = dict(list(self._ids.items()))
+        self.dirty = False
+        if self.cursor_file is None:
+            return
+        try:
+            tmp_file = self.cursor_file + '.tmp'
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(records, f)
+            os.replace(tmp_file, self.cursor_file)
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении позиций чатов: {e}")
+
+# Планировщик самостоятельных сообщений
+class ConversationScheduler:
+    """Очередь дедлайнов по чатам на min-heap.
+
+    Для каждого чата хранится один актуальный дедлайн; при переносе старая
+    запись остается в куче и пропускается. Сработавшие чаты обрабатываются
+    отдельными задачами, одновременно не больше concurrency.
+    """
+    def __init__(self, callback, concurrency=5):
+        self.callback = callback  # async callback(chat_id)
+        self._heap = []  # (дедлайн, порядковый номер, chat_id)
+        self._deadlines = {}  # chat_id -> актуальный дедлайн
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tasks = set()
+
+    def schedule(self, chat_id, deadline):
+        """Назначает (или переносит) срабатывание чата на момент deadline."""
+        self._deadlines[chat_id] = deadline
+        earliest = not self._heap or deadline < self._heap[0][0]
+        heapq.heappush(self._heap, (deadline, next(self._counter), chat_id))
+        # Устаревшие записи чистим, когда их становится больше актуальных
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._heap = [(when, next(self._counter), cid) for cid, when in self._deadlines.items()]
+            heapq.heapify(self._heap)
+        if earliest:
+            self._wakeup.set()
+
+    def cancel(self, chat_id):
+        self._deadlines.pop(chat_id, None)
+
+    def scheduled(self):
+        return set(self._deadlines)
+
+    def _pop_stale(self):
+        while self._heap:
+            deadline, _, chat_id = self._heap[0]
+            if self._deadlines.get(chat_id) == deadline:
+                return
+            heapq.heappop(self._heap)
+
+    async def run(self):
+        while True:
+            self._pop_stale()
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            if timeout is None or timeout > 0:
+                # Спим до ближайшего дедлайна или до появления более раннего
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, _, chat_id = heapq.heappop(self._heap)
+            del self._deadlines[chat_id]
+            task = asyncio.create_task(self._fire(chat_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _fire(self, chat_id):
+        async with self._semaphore:
+            try:
+                await self.callback(chat_id)
+            except Exception as e:
+                logger.error(f"Ошибка в запланированной задаче чата {chat_id}: {e}")
+
+# Ограничение частоты отправки
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас."""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0  # После FloodWait ведро временно закрыто
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+# Исходящее сообщение в очереди отправки
+class OutgoingMessage:
+    def __init__(self, entity, text, delay=0.0, typing=False):
+        self.entity = entity
+        self.text = text
+        self.delay = delay  # Пауза перед отправкой для имитации человека
+        self.typing = typing  # Показывать ли "печатает..." во время паузы
+        self.enqueued = time.monotonic()
+        self.future = asyncio.get_running_loop().create_future()
+
+# Конвейер отправки сообщений
+class SendPipeline:
+    """Очереди отправки по чатам с ограничением частоты и повтором после FloodWait.
+
+    Сообщения одного чата уходят строго по порядку; чаты обслуживаются
+    независимо. Частота ограничена ведром токенов чата и общим ведром.
+    """
+    def __init__(self, client, per_chat_rate=0.5, per_chat_burst=3, global_rate=5, global_burst=10,
+                 queue_size=20, drop_policy='oldest', max_retries=3):
+        if drop_policy not in ('oldest', 'newest'):
+            raise ValueError(f"Неизвестная политика отбрасывания: {drop_policy}")
+        self.client = client
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.queue_size = queue_size
+        self.drop_policy = drop_policy
+        self.max_retries = max_retries
+        self._queues = defaultdict(deque)  # chat_id -> очередь OutgoingMessage
+        self._buckets = {}
+        self._workers = {}  # chat_id -> задача, разбирающая очередь чата
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.flood_waits = 0
+        self.latencies = deque(maxlen=1000)  # От постановки в очередь до отправки, сек
+
+    def send(self, chat_id, entity, text, delay=0.0, typing=False):
+        """Ставит сообщение в очередь чата; возвращает future с результатом отправки."""
+        message = OutgoingMessage(entity, text, delay, typing)
+        # Ошибки уже записаны в лог, результат может никто не ждать
+        message.future.add_done_callback(lambda future: future.cancelled() or future.exception())
+        queue = self._queues[chat_id]
+        if len(queue) >= self.queue_size:
+            self.dropped += 1
+            if self.drop_policy == 'newest':
+                # Отброшенное сообщение отменяется, как и при политике 'oldest'
+                message.future.cancel()
+                logger.warning(f"Очередь отправки чата {chat_id} переполнена, новое сообщение отброшено")
+                return message.future
+            queue.popleft().future.cancel()
+            logger.warning(f"Очередь отправки чата {chat_id} переполнена, старое сообщение отброшено")
+        queue.append(message)
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._worker(chat_id))
+        return message.future
+
+    def pending(self, chat_id):
+        return len(self._queues.get(chat_id, ()))
+
+    def busy(self):
+        return bool(self._workers)
+
+    async def _worker(self, chat_id):
+        queue = self._queues[chat_id]
+        try:
+            while queue:
+                await self._deliver(chat_id, queue.popleft())
+        finally:
+            # Между проверкой очереди и этим местом нет await, новое сообщение не потеряется
+            del self._workers[chat_id]
+            if not queue:
+                del self._queues[chat_id]
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+        return bucket
+
+    async def _deliver(self, chat_id, message):
+        if message.future.done():
+            return
+        bucket = self._bucket(chat_id)
+        for attempt in range(self.max_retries + 1):
+            try:
+                if message.delay > 0:
+                    with metrics.stage('typing_delay'):
+                        if message.typing:
+                            async with self.client.action(message.entity, 'typing'):
+                                await asyncio.sleep(message.delay)
+                        else:
+                            await asyncio.sleep(message.delay)
+                    # При повторе после FloodWait не ждем и не "печатаем" заново
+                    message.delay = 0
+                with metrics.stage('rate_limit'):
+                    await bucket.acquire()
+                    await self.global_bucket.acquire()
+                with metrics.stage('send'):
+                    result = await self.client.send_message(message.entity, message.text)
+            except FloodWaitError as e:
+                self.flood_waits += 1
+                # FloodWait ограничивает весь аккаунт, а не только этот чат
+                bucket.block(e.seconds)
+                self.global_bucket.block(e.seconds)
+                logger.warning(f"FloodWait {e.seconds} с при отправке в чат {chat_id} (попытка {attempt + 1})")
+                continue
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Ошибка при отправке сообщения в чат {chat_id}: {e}")
+                message.future.set_exception(e)
+                return
+            self.sent += 1
+            self.latencies.append(time.monotonic() - message.enqueued)
+            logger.info("Отправлено сообщение в чат %s: %s", chat_id, message.text)
+            message.future.set_result(result)
+            return
+        self.failed += 1
+        logger.error(f"Сообщение в чат {chat_id} не отправлено после {self.max_retries} повторов")
+        message.future.set_exception(RuntimeError(f"Превышено число повторов отправки в чат {chat_id}"))
+
+    def stats(self):
+        depths = [len(queue) for queue in self._queues.values()]
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else 0.0
+
+        return {
+            'queued': sum(depths),
+            'max_queue_depth': max(depths, default=0),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'flood_waits': self.flood_waits,
+            'latency_p50': percentile(0.5),
+            'latency_p99': percentile(0.99),
+        }
+
+# Координатор ответов на всплески сообщений
+class ReplyCoordinator:
+    """Собирает всплеск сообщений чата и отвечает на него один раз, когда чат затихнет.
+
+    Каждое новое сообщение переносит ответ на quiet_period секунд, но не дальше
+    чем на max_wait от начала всплеска. Одновременно в чате готовится не больше
+    max_inflight ответов, лишние всплески остаются без ответа.
+    """
+    def __init__(self, reply_callback, quiet_period=3, max_wait=15, window=10, max_inflight=1):
+        self.reply_callback = reply_callback  # async reply_callback(chat_id, chat, messages)
+        self.quiet_period = quiet_period
+        self.max_wait = max_wait
+        self.max_inflight = max_inflight
+        self._windows = defaultdict(lambda: deque(maxlen=window))  # Последние сообщения чата
+        self._pending = {}  # chat_id -> задача, ждущая тишины
+        self._burst_started = {}
+        self._inflight = defaultdict(int)
+        self.coalesced = 0  # Сообщения, объединенные с другими в один ответ
+        self.skipped = 0  # Всплески, оставшиеся без ответа из-за лимита
+
+    def message(self, chat_id, chat, text):
+        """Учитывает новое сообщение чата и (пере)назначает ответ."""
+        self._windows[chat_id].append(text)
+        now = time.monotonic()
+        started = self._burst_started.setdefault(chat_id, now)
+        task = self._pending.get(chat_id)
+        if task is not None:
+            self.coalesced += 1
+            if now - started >= self.max_wait:
+                # Всплеск затянулся: ответ уже не переносим
+                return
+            task.cancel()
+        delay = min(self.quiet_period, started + self.max_wait - now)
+        self._pending[chat_id] = asyncio.create_task(self._reply_when_quiet(chat_id, chat, delay))
+
+    async def _reply_when_quiet(self, chat_id, chat, delay):
+        await asyncio.sleep(delay)
+        # Дальше задачу не отменяют: новые сообщения начнут следующий всплеск
+        del self._pending[chat_id]
+        del self._burst_started[chat_id]
+        messages = list(self._windows.pop(chat_id, ()))
+        if self._inflight[chat_id] >= self.max_inflight:
+            self.skipped += 1
+            return
+        self._inflight[chat_id] += 1
+        try:
+            await self.reply_callback(chat_id, chat, messages)
+        except Exception as e:
+            logger.error(f"Ошибка при ответе в чат {chat_id}: {e}")
+        finally:
+            self._inflight[chat_id] -= 1
+
+    def busy(self):
+        """Есть ли ответы, ждущие тишины или уже готовящиеся."""
+        return bool(self._pending) or any(self._inflight.values())
+
+# Основной класс бота
+class HumanLikeBot:
+    LEARN_PUT_TIMEOUT = 1  # Сколько ждать места в очереди обучения, сек
+    CONFIG_POLL_INTERVAL = 5  # Как часто проверять изменение config.json, сек
+    MAINTENANCE_INTERVAL = 60  # Период обслуживания моделей и кэшей, сек
+    DECAY_CHUNK = 1000  # Сколько слов обрабатывать за одну блокировку модели
+    DECAY_BUDGET_SPEEDUP = 10  # Во сколько раз ускорять затухание модели сверх бюджета
+    PRECOMPUTE_INTERVAL = 2  # Как часто проверять простой для подготовки ответов, сек
+    CONNECTION_POLL_INTERVAL = 5  # Как часто проверять подключение к Telegram, сек
+    SHARD_POLL_INTERVAL = 1  # Как часто проверять команды супервизора, сек
+    
+    def __init__(self, shard=None):
+        self.started = time.perf_counter()  # От этого момента отсчитываются фазы запуска
+        self.config = BotConfig()
+        # Связь с супервизором, если бот - один из процессов-обработчиков режима --supervisor
+        self.shard = shard
+        self.shard_task = None
+        set_log_level(self.config.log_level)
+        # Токенизатор (nltk импортируется долго) и общая модель загружаются в фоне (load_model);
+        # до этого отвечает запасная модель из базовых фраз
+        self.tokenizer = None
+        self.learner = MessageLearner('message_data.json', tokenizer=make_tokenizer(), retrieval=False,
+                                      response_cache_size=0, read_only=True, load=False)
+        self.model_ready = asyncio.Event()
+        self.model_task = None
+        self.warm_up_task = None
+        self.models = None
+        if self.config.per_chat_models:
+            budget = self.config.model_memory_budget_mb * 1024 * 1024 or None
+            self.models = LearnerRegistry(self.make_learner, self.config.models_dir,
+                                          idle_timeout=self.config.model_idle_timeout,
+                                          max_loaded=self.config.max_loaded_models,
+                                          memory_budget=budget)
+        self.maintenance_task = None
+        self.precompute_task = None
+        if shard is None:
+            self.cursors = ChatCursors(self.config.cursor_file)
+        else:
+            # Чаты переходят между обработчиками, поэтому позиции ведет супервизор
+            self.cursors = ChatCursors(None)
+            self.cursors.merge(shard.cursors)
+        self.catch_up_task = None
+        self.connection_task = None
+        self.entities = None  # Кэш сущностей, создается вместе с клиентом
+        self.sender = None  # Конвейер отправки, создается вместе с клиентом
+        self.initiate_task = None
+        self.replies = ReplyCoordinator(self.reply_to_burst,
+                                        quiet_period=self.config.reply_quiet_period,
+                                        max_wait=self.config.reply_max_wait,
+                                        window=self.config.reply_window,
+                                        max_inflight=self.config.max_inflight_replies)
+        # Отслеживаемые чаты: числовой id -> id из конфигурации (пересобирается целиком)
+        self.tracked_chats = self.build_tracked_chats(self.owned_chats(self.config.chat_ids))
+        self.config_mtime = self.get_config_mtime()
+        self.config_task = None
+        self.scheduler = ConversationScheduler(self.initiate_in_chat, self.config.initiate_concurrency)
+        self.client = None
+        self.active_chats = {}  # Для отслеживания активных диалогов
+        self.last_message_time = {}  # Для отслеживания времени последнего сообщения в чате
+        self.initialized = False
+        # Обучение, генерация и сохранение не должны блокировать цикл событий
+        self.executor = ThreadPoolExecutor(max_workers=self.config.worker_threads, thread_name_prefix='bot-worker')
+        self.learn_queue = asyncio.Queue(maxsize=self.config.learn_queue_size)
+        self.learn_task = None
+        self.learn_dropped = 0  # Сообщения, отброшенные из-за переполнения очереди
+        self.metrics_server = None
+        metrics.register('bot', self.collect_metrics)
+    
+    async def initialize(self):
+        if not self.config.api_id or not self.config.api_hash:
+            logger.error("API ID или API Hash не настроены. Пожалуйста, заполните config.json")
+            return False
+        
+        # Создание клиента Telegram
+        session_name = self.shard.session if self.shard is not None else self.config.session_name
+        with self.startup_phase('connect'):
+            self.client = TelegramClient(session_name, self.config.api_id, self.config.api_hash)
+            await self.client.start()
+        # Сущности привязаны к аккаунту (access_hash), поэтому кэш у каждой сессии свой
+        self.entities = EntityCache(self.client, self.session_file(self.config.entity_cache_file),
+                                    ttl=self.config.entity_ttl,
+                                    negative_ttl=self.config.entity_negative_ttl)
+        self.sender = self.make_sender(self.client)
+        
+        self.initialized = True
+        logger.info("Бот успешно инициализирован и подключен к Telegram")
+        return True
+    
+    async def warm_up(self):
+        """Проверяет доступ к чатам и рассылает приветствия, не больше startup_concurrency чатов одновременно."""
+        chat_ids = self.owned_chats(self.config.chat_ids)
+        print(f"Проверка доступа к чатам: {chat_ids}")
+        semaphore = asyncio.Semaphore(self.config.startup_concurrency)
+        
+        async def resolve(chat_id):
+            async with semaphore:
+                try:
+                    chat = await self.entities.get(int(chat_id))
+                    print(f"Успешно получен доступ к чату: {chat_id} - {getattr(chat, 'title', 'Личный чат')}")
+                    # Инициализируем время последнего сообщения
+                    self.last_message_time[str(chat_id)] = time.time()
+                    return chat
+                except Exception as e:
+                    print(f"Ошибка при доступе к чату {chat_id}: {e}")
+                    logger.error(f"Ошибка при доступе к чату {chat_id}: {e}")
+                    return None
+        
+        with self.startup_phase('chats'):
+            chats = await asyncio.gather(*(resolve(chat_id) for chat_id in chat_ids))
+        
+        # Приветствия берутся из загруженной модели: в ней бывают свои варианты
+        await self.model_ready.wait()
+        print("Отправка приветственных сообщений")
+        with self.startup_phase('greetings'):
+            for chat_id, entity in zip(chat_ids, chats):
+                if entity is None:
+                    continue
+                greeting = self.learner.humanize_message(self.learner.get_greeting())
+                # Отправка идет через конвейер, приветствия в разные чаты не ждут друг друга
+                self.sender.send(chat_id, entity, greeting)
+                logger.info(f"Приветствие для чата {chat_id} поставлено в очередь: {greeting}")
+    
+    def make_sender(self, client):
+        return SendPipeline(client,
+                            per_chat_rate=self.config.send_rate_per_chat,
+                            per_chat_burst=self.config.send_burst_per_chat,
+                            global_rate=self.config.send_rate_global,
+                            global_burst=self.config.send_burst_global,
+                            queue_size=self.config.send_queue_size,
+                            drop_policy=self.config.send_drop_policy,
+                            max_retries=self.config.send_max_retries)
+    
+    def make_learner(self, data_file):
+        return MessageLearner(data_file,
+                              pattern_limit=self.config.pattern_limit,
+                              response_limit=self.config.response_limit,
+                              eviction_policy=self.config.eviction_policy,
+                              tokenizer=self.tokenizer,
+                              retrieval=self.config.retrieval_enabled,
+                              retrieval_min_score=self.config.retrieval_min_score,
+                              response_cache_size=self.config.response_cache_size,
+                              response_cache_pool=self.config.response_cache_pool,
+                              read_only=self.shard is not None)
+    
+    def session_file(self, path):
+        """Файл состояния сессии: у каждого процесса-обработчика свой."""
+        if self.shard is None:
+            return path
+        root, ext = os.path.splitext(path)
+        return f"{root}.{self.shard.session}{ext}"
+    
+    def owned_chats(self, chat_ids):
+        """Чаты, которые обслуживает этот процесс (обработчик берет только свою долю)."""
+        if self.shard is None:
+            return chat_ids
+        return [chat_id for chat_id in chat_ids if self.shard.owns(chat_id)]
+    
+    def load_learner(self):
+        """Создает токенизатор и читает общую модель (выполняется в рабочем потоке)."""
+        self.tokenizer = make_tokenizer(self.config.tokenizer)
+        return self.make_learner('message_data.json')
+    
+    async def load_model(self):
+        """Загружает общую модель в фоне и подменяет ею запасную."""
+        with self.startup_phase('model'):
+            learner = await self.run_in_worker(self.load_learner)
+        placeholder, self.learner = self.learner, learner
+        placeholder.close()
+        self.model_ready.set()
+    
+    @contextlib.contextmanager
+    def startup_phase(self, phase):
+        """Засекает фазу запуска и пишет ее длительность в лог и метрики."""
+        started = time.perf_counter()
+        yield
+        self.log_startup(phase, started)
+    
+    def log_startup(self, phase, started):
+        now = time.perf_counter()
+        metrics.observe('bot_startup_seconds', now - started, phase=phase)
+        logger.info(f"Запуск, {phase}: {now - started:.2f} с (с начала запуска {now - self.started:.2f} с)")
+    
+    def learner_for(self, chat_id, touch=True):
+        """Контекст с моделью чата (или общей моделью, если модели чатов отключены)."""
+        if self.models is None or chat_id is None:
+            return contextlib.nullcontext(self.learner)
+        return self.models.use(chat_id, touch)
+    
+    async def run_in_worker(self, func, *args):
+        """Выполняет блокирующую функцию в пуле рабочих потоков."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+    
+    async def enqueue_learning(self, chat_id, message_text):
+        """Ставит сообщение в очередь обучения; при переполнении ждет, затем отбрасывает."""
+        try:
+            await asyncio.wait_for(self.learn_queue.put((chat_id, message_text)), timeout=self.LEARN_PUT_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.learn_dropped += 1
+            logger.warning(f"Очередь обучения переполнена, сообщение отброшено (всего {self.learn_dropped})")
+    
+    async def learn_worker(self):
+        """Забирает сообщения из очереди и обучается на них пачками в рабочем потоке."""
+        unsaved = 0
+        # Сообщения копятся в очереди, пока загружается модель
+        await self.model_ready.wait()
+        while True:
+            batch = [await self.learn_queue.get()]
+            while len(batch) < self.config.learn_batch_size and not self.learn_queue.empty():
+                batch.append(self.learn_queue.get_nowait())
+            try:
+                await self.run_in_worker(self.learn_messages, batch)
+                self.publish_cursors()
+                # Сохраняем данные примерно каждые 10 сообщений
+                unsaved += len(batch)
+                if unsaved >= 10:
+                    unsaved = 0
+                    await self.run_in_worker(self.save_models)
+            except Exception as e:
+                logger.error(f"Ошибка при обучении на пачке сообщений: {e}")
+            finally:
+                for _ in batch:
+                    self.learn_queue.task_done()
+    
+    def publish_cursors(self):
+        """Передает супервизору сдвинувшиеся позиции чатов (в режиме обработчика)."""
+        if self.shard is not None:
+            changes = self.cursors.changes()
+            if changes:
+                self.shard.updates.put(('cursors', changes))
+    
+    def learn_messages(self, batch):
+        """Обучает модели чатов (и общую модель) на пачке пар (чат, текст)."""
+        if self.shard is not None:
+            # Модели пишет только супервизор, обработчик пересылает ему сообщения
+            self.shard.updates.put(('learn', batch))
+            metrics.inc('bot_forwarded_messages_total', len(batch))
+            return
+        by_chat = defaultdict(list)
+        for chat_id, message_text in batch:
+            by_chat[chat_id].append(message_text)
+        with metrics.stage('learn'):
+            if self.models is not None:
+                for chat_id, messages in by_chat.items():
+                    with self.models.use(chat_id) as learner:
+                        learner.learn_batch(messages)
+            if self.models is None or self.config.shared_model:
+                self.learner.learn_batch([message_text for _, message_text in batch])
+        metrics.inc('bot_learned_messages_total', len(batch))
+    
+    def save_models(self):
+        with metrics.stage('save'):
+            self.learner.save_data()
+            if self.models is not None:
+                self.models.save_all()
+    
+    def build_reply(self, chat_id=None, message_text=None, exclude=()):
+        """Генерирует и "очеловечивает" ответ (выполняется в рабочем потоке)."""
+        if not self.model_ready.is_set():
+            # Модели еще загружаются: отвечаем запасной моделью из базовых фраз
+            metrics.inc('bot_degraded_replies_total')
+            return self.learner.humanize_message(self.learner.generate_response(message_text, exclude=exclude))
+        fallback = self.learner if self.models is not None and self.config.shared_model else None
+        with self.learner_for(chat_id) as learner:
+            with metrics.stage('generate'):
+                response = learner.generate_response(message_text, fallback=fallback, exclude=exclude)
+            with metrics.stage('humanize'):
+                return learner.humanize_message(response)
+    
+    def publish_models(self):
+        """Сворачивает журналы моделей в снимки, которые читают процессы-обработчики."""
+        self.save_models()
+        for learner in [self.learner] + (self.models.learners() if self.models is not None else []):
+            learner.journal.compact()
+    
+    def reload_models(self):
+        """Перечитывает модели, снимки которых обновил супервизор."""
+        if self.learner.stale():
+            stale, self.learner = self.learner, self.make_learner('message_data.json')
+            stale.close()
+        if self.models is not None:
+            self.models.drop_stale()
+    
+    def decay_model(self, chat_id=None):
+        """Шаг затухания модели чата (или общей), пропорциональный времени между обслуживаниями."""
+        config = self.config
+        with self.learner_for(chat_id, touch=False) as learner:
+            due = len(learner.word_associations.words) * self.MAINTENANCE_INTERVAL / config.model_decay_interval
+            if learner.over_budget(config.model_max_transitions):
+                due *= self.DECAY_BUDGET_SPEEDUP
+            # Дробный остаток переносится на следующие шаги, чтобы малые модели тоже затухали
+            learner.decay_credit += due
+            rows = int(learner.decay_credit)
+            learner.decay_credit -= rows
+            removed = 0
+            done = 0
+            with metrics.stage('decay'):
+                # Блокировка модели отпускается между отрезками, обучение и ответы не ждут весь шаг
+                while done < rows:
+                    chunk = min(self.DECAY_CHUNK, rows - done)
+                    removed += learner.decay_step(chunk, config.model_decay_factor,
+                                                  config.model_min_count, config.model_max_transitions)
+                    done += chunk
+            metrics.inc('bot_pruned_transitions_total', removed)
+    
+    def precompute_model(self, chat_id=None):
+        """Пополняет кэш готовых ответов модели чата (или общей)."""
+        with self.learner_for(chat_id, touch=False) as learner:
+            with metrics.stage('precompute'):
+                return learner.precompute_responses()
+    
+    def is_idle(self):
+        """Бот простаивает: нечему учиться, ответы не готовятся и не отправляются."""
+        return (self.learn_queue.empty() and not self.replies.busy()
+                and (self.sender is None or not self.sender.busy()))
+    
+    async def precompute_worker(self):
+        """В простое заранее генерирует ответы для частых стартовых слов."""
+        while True:
+            await asyncio.sleep(self.PRECOMPUTE_INTERVAL)
+            try:
+                chat_ids = [None] + (self.models.loaded() if self.models is not None else [])
+                for chat_id in chat_ids:
+                    # Проверяем перед каждой моделью: пришедшее сообщение важнее прогрева кэша
+                    if not self.is_idle():
+                        break
+                    await self.run_in_worker(self.precompute_model, chat_id)
+            except Exception as e:
+                logger.error(f"Ошибка при подготовке ответов: {e}")
+    
+    def collect_metrics(self):
+        """Показатели, которые компоненты бота считают сами, для реестра метрик."""
+        samples = [('bot_learn_queue_size', {}, self.learn_queue.qsize()),
+                   ('bot_learn_dropped', {}, self.learn_dropped),
+                   ('bot_replies_coalesced', {}, self.replies.coalesced),
+                   ('bot_replies_skipped', {}, self.replies.skipped),
+                   ('bot_tracked_chats', {}, len(self.tracked_chats))]
+        if self.models is not None:
+            samples.append(('bot_models_loaded', {}, len(self.models.loaded())))
+        if self.entities is not None:
+            samples.extend((f'bot_entity_cache_{key}', {}, value) for key, value in self.entities.stats().items())
+        if self.sender is not None:
+            samples.extend((f'bot_send_{key}', {}, value) for key, value in self.sender.stats().items())
+        learners = [self.learner] + (self.models.learners() if self.models is not None else [])
+        caches = [learner.response_cache.stats() for learner in learners if learner.response_cache is not None]
+        if caches:
+            for key in ('size', 'hits', 'misses', 'invalidations'):
+                samples.append((f'bot_response_cache_{key}', {}, sum(cache[key] for cache in caches)))
+            lookups = sum(cache['hits'] + cache['misses'] for cache in caches)
+            samples.append(('bot_response_cache_hit_rate', {},
+                            sum(cache['hits'] for cache in caches) / lookups if lookups else 0.0))
+        return samples
+    
+    def hold_cursors(self):
+        """Замораживает позиции отслеживаемых чатов, которые уже есть; возвращает эти чаты."""
+        chat_ids = [chat_id for chat_id in set(self.tracked_chats.values()) if self.cursors.get(chat_id) is not None]
+        for chat_id in chat_ids:
+            self.cursors.hold(chat_id)
+        return chat_ids
+    
+    def start_catch_up(self):
+        """Запускает (или перезапускает) догрузку пропущенных сообщений в фоне."""
+        if not self.config.catch_up_enabled or not self.config.learning_enabled:
+            return
+        if self.catch_up_task is not None:
+            # Прерванная догрузка сдвигает позиции до изученного, но оставляет их замороженными для новой
+            self.catch_up_task.cancel()
+        self.catch_up_task = asyncio.create_task(self.catch_up(self.hold_cursors()))
+    
+    async def catch_up(self, chat_ids):
+        """Догружает пропущенное во всех чатах, не больше catch_up_concurrency чатов одновременно."""
+        await self.model_ready.wait()
+        started = time.perf_counter()
+        semaphore = asyncio.Semaphore(self.config.catch_up_concurrency)
+        
+        async def catch_up_limited(chat_id):
+            async with semaphore:
+                try:
+                    return await self.catch_up_chat(chat_id)
+                except Exception as e:
+                    logger.error(f"Ошибка при догрузке сообщений чата {chat_id}: {e}")
+                    return 0
+        
+        counts = await asyncio.gather(*(catch_up_limited(chat_id) for chat_id in chat_ids))
+        logger.info(f"Догружено {sum(counts)} пропущенных сообщений из {len(chat_ids)} чатов "
+                    f"за {time.perf_counter() - started:.1f} с")
+    
+    async def catch_up_chat(self, chat_id):
+        """Обучается на сообщениях чата после последнего изученного; возвращает их количество.
+
+        Позиция сдвигается только до изученного: после ошибки оставшаяся часть
+        пропуска не загрузится повторно, но и изученное не будет учтено дважды.
+        """
+        progress = self.cursors.get(chat_id)  # До этого сообщения пропуск изучен
+        complete = cancelled = False
+        learned = 0
+        try:
+            entity = await self.entities.get(chat_id)
+            latest = await self.client.get_messages(entity, limit=1)
+            until = latest[0].id if latest else progress
+            if until > progress and self.config.catch_up_limit:
+                # Из длинного пропуска берем только последние catch_up_limit сообщений
+                oldest = await self.client.get_messages(entity, limit=1, offset_id=until + 1,
+                                                        add_offset=self.config.catch_up_limit - 1)
+                if oldest and oldest[0].id > progress:
+                    progress = oldest[0].id - 1
+            if until > progress:
+                page = []
+                # От старых сообщений к новым, как при живом обучении: из ограниченных
+                # коллекций первыми вытесняются самые старые
+                async for message in self.client.iter_messages(entity, min_id=progress, max_id=until + 1,
+                                                               reverse=True):
+                    if message.message and not message.out and not self.cursors.seen(chat_id, message.id):
+                        page.append((chat_id, message.message))
+                    if len(page) >= self.config.catch_up_batch:
+                        await self.run_in_worker(self.learn_messages, page)
+                        learned += len(page)
+                        progress = message.id
+                        page = []
+                if page:
+                    await self.run_in_worker(self.learn_messages, page)
+                    learned += len(page)
+                await self.run_in_worker(self.save_models)
+                metrics.inc('bot_caught_up_messages_total', learned)
+                logger.info(f"Чат {chat_id}: изучено {learned} пропущенных сообщений")
+            progress = max(progress, until)
+            complete = True
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            self.cursors.release(chat_id, progress, complete, keep_hold=cancelled)
+            self.publish_cursors()
+        return learned
+    
+    async def watch_connection(self):
+        """Следит за подключением к Telegram и догружает пропущенное после переподключения."""
+        connected = True
+        while True:
+            await asyncio.sleep(self.CONNECTION_POLL_INTERVAL)
+            now_connected = self.client.is_connected()
+            if connected and not now_connected:
+                logger.warning("Соединение с Telegram потеряно")
+                # Сообщения после переподключения не должны сдвинуть позиции через пропуск
+                self.hold_cursors()
+            elif now_connected and not connected:
+                logger.info("Соединение с Telegram восстановлено, догружаем пропущенные сообщения")
+                self.start_catch_up()
+            connected = now_connected
+    
+    async def watch_shard(self):
+        """Выполняет команды супервизора: новый состав обработчиков или остановку."""
+        while True:
+            await asyncio.sleep(self.SHARD_POLL_INTERVAL)
+            try:
+                while self.shard.control.poll():
+                    command, payload = self.shard.control.recv()
+                    if command == 'members':
+                        members, cursors = payload
+                        self.cursors.merge(cursors)
+                        owned = set(self.tracked_chats.values())
+                        self.shard.ring = HashRing(members)
+                        self.refresh_tracked_chats()
+                        logger.info(f"Обработчики: {members}, у сессии {self.shard.session} "
+                                    f"{len(self.tracked_chats)} чатов")
+                        if set(self.tracked_chats.values()) - owned:
+                            # Доставшиеся чаты догружаем с позиций, до которых их изучил прежний обработчик
+                            self.start_catch_up()
+                    elif command == 'stop':
+                        await self.client.disconnect()
+                        return
+            except (EOFError, OSError):
+                logger.error("Связь с супервизором потеряна, обработчик останавливается")
+                await self.client.disconnect()
+                return
+    
+    async def maintenance(self):
+        """Периодически прореживает модели, выгружает модели простаивающих чатов, сохраняет кэш сущностей и позиции чатов."""
+        await self.model_ready.wait()
+        while True:
+            await asyncio.sleep(self.MAINTENANCE_INTERVAL)
+            try:
+                if self.shard is not None:
+                    await self.run_in_worker(self.reload_models)
+                elif self.config.model_decay_interval:
+                    await self.run_in_worker(self.decay_model)
+                    for chat_id in self.models.loaded() if self.models is not None else ():
+                        await self.run_in_worker(self.decay_model, chat_id)
+                if self.models is not None:
+                    await self.run_in_worker(self.models.evict)
+                if self.entities is not None and self.entities.dirty:
+                    await self.run_in_worker(self.entities.save)
+                self.publish_cursors()
+                if self.cursors.dirty:
+                    await self.run_in_worker(self.cursors.save)
+                if self.config.metrics_file:
+                    # Сборщики читают состояние бота, поэтому текст готовим в цикле событий
+                    await self.run_in_worker(metrics.dump, self.session_file(self.config.metrics_file),
+                                             metrics.render())
+            except Exception as e:
+                logger.error(f"Ошибка при обслуживании: {e}")
+    
+    async def shutdown(self):
+        """Дообучается на очереди, останавливает рабочие потоки и сохраняет модель."""
+        if self.model_task is not None:
+            # Модель дозагружается: ждем ее, чтобы закрыть загруженную, а не запасную
+            try:
+                await self.model_task
+            except Exception as e:
+                logger.error(f"Ошибка при загрузке модели: {e}")
+        if self.learn_task:
+            try:
+                await asyncio.wait_for(self.learn_queue.join(), timeout=10)
+            except asyncio.TimeoutError:
+                logger.warning(f"Не дождались обучения на {self.learn_queue.qsize()} сообщениях")
+            self.learn_task.cancel()
+        for task in (self.maintenance_task, self.precompute_task, self.config_task, self.initiate_task,
+                     self.catch_up_task, self.connection_task, self.shard_task, self.warm_up_task):
+            if task:
+                task.cancel()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        self.executor.shutdown(wait=True)
+        if self.entities is not None:
+            self.entities.save()
+        self.publish_cursors()
+        if self.cursors.dirty:
+            self.cursors.save()
+        # Дописываем журналы и сворачиваем их в снимки перед выходом
+        if self.models is not None:
+            self.models.close_all()
+        self.learner.close()
+    
+    @staticmethod
+    def build_tracked_chats(chat_ids):
+        tracked = {}
+        for cid in chat_ids:
+            try:
+                tracked[int(cid)] = str(cid)
+            except (TypeError, ValueError):
+                logger.error(f"Некорректный ID чата в конфигурации: {cid}")
+        return tracked
+    
+    def tracked_chat(self, chat_id):
+        """Возвращает ID чата из конфигурации или None, если чат не отслеживается.
+
+        В конфигурации ID может быть записан как с префиксом (-100...), так и без него.
+        """
+        if chat_id is None:
+            return None
+        tracked = self.tracked_chats
+        key = tracked.get(chat_id)
+        if key is None:
+            key = tracked.get(utils.resolve_id(chat_id)[0])
+        return key
+    
+    def is_bot_chat(self, chat_id):
+        """Проверяет, находится ли чат в списке отслеживаемых чатов."""
+        return self.tracked_chat(int(chat_id)) is not None
+    
+    def get_config_mtime(self):
+        try:
+            return os.path.getmtime(self.config.config_file)
+        except OSError:
+            return None
+    
+    def refresh_tracked_chats(self):
+        # Новый словарь подставляется одним присваиванием, обработчик не видит промежуточного состояния
+        self.tracked_chats = self.build_tracked_chats(self.owned_chats(self.config.chat_ids))
+        self.sync_schedule()
+    
+    def idle_deadline(self, chat_id):
+        """Момент, когда чат будет считаться затихшим (10 минут - 1 час после последнего сообщения)."""
+        return self.last_message_time.get(chat_id, time.time()) + random.randint(600, 3600)
+    
+    def sync_schedule(self):
+        """Планирует новые отслеживаемые чаты и снимает с расписания удаленные."""
+        tracked = set(self.tracked_chats.values())
+        scheduled = self.scheduler.scheduled()
+        for chat_id in tracked - scheduled:
+            self.scheduler.schedule(chat_id, self.idle_deadline(chat_id))
+        for chat_id in scheduled - tracked:
+            self.scheduler.cancel(chat_id)
+    
+    def save_config(self):
+        self.config.save_config()
+        self.config_mtime = self.get_config_mtime()
+        self.refresh_tracked_chats()
+    
+    async def watch_config(self):
+        """Перечитывает config.json при его изменении и обновляет список отслеживаемых чатов."""
+        while True:
+            await asyncio.sleep(self.CONFIG_POLL_INTERVAL)
+            mtime = self.get_config_mtime()
+            if mtime is None or mtime == self.config_mtime:
+                continue
+            try:
+                self.config.load_config()
+                self.config_mtime = mtime
+                set_log_level(self.config.log_level)
+                self.refresh_tracked_chats()
+                logger.info(f"Конфигурация перечитана, отслеживаемые чаты: {self.config.chat_ids}")
+            except Exception as e:
+                logger.error(f"Ошибка при перечитывании конфигурации: {e}")
     
     async def add_chat(self, chat_id):
         """Добавляет чат в список отслеживаемых."""
         chat_id_str = str(chat_id)
-        if chat_id_str not in [str(cid) for cid in self.config.chat_ids]:
+        if not self.is_bot_chat(chat_id):
             self.config.chat_ids.append(chat_id_str)
-            self.config.save_config()
+            self.save_config()
             logger.info(f"Чат {chat_id} добавлен в список отслеживаемых")
             return True
         return False
     
     async def remove_chat(self, chat_id):
         """Удаляет чат из списка отслеживаемых."""
-        chat_id_str = str(chat_id)
-        if chat_id_str in [str(cid) for cid in self.config.chat_ids]:
-            self.config.chat_ids.remove(chat_id_str)
-            self.config.save_config()
+        chat_id_str = self.tracked_chat(int(chat_id))
+        if chat_id_str is not None:
+            self.config.chat_ids = [cid for cid in self.config.chat_ids if str(cid) != chat_id_str]
+            self.save_config()
             logger.info(f"Чат {chat_id} удален из списка отслеживаемых")
             return True
         return False
@@ -345,140 +3168,138 @@ class HumanLikeBot:
     async def process_incoming_message(self, event):
         """Обрабатывает входящие сообщения."""
         try:
-            # Получаем информацию о чате
-            chat = await event.get_chat()
-            chat_id = str(getattr(chat, 'id', None))
+            # Сообщения из неотслеживаемых чатов отбрасываем до любой другой работы
+            chat_id = self.tracked_chat(event.chat_id)
+            if chat_id is None:
+                metrics.inc('bot_messages_total', result='untracked')
+                return
+            # Позиция нужна, чтобы после перезапуска догрузить пропущенные сообщения
+            self.cursors.advance(chat_id, event.message.id)
             
-            # Выводим информацию о полученном сообщении
-            sender = await event.get_sender()
-            sender_id = getattr(sender, 'id', 'Unknown')
-            is_self = sender and sender.is_self
+            # Подробности о сообщении пишем только на уровне DEBUG
+            is_self = event.out
             message_text = event.message.message
-            print(f"Сообщение от {sender_id} в чате {chat_id}: {message_text}")
-            print(f"Это собственное сообщение: {is_self}")
-            print(f"Чат в списке: {self.is_bot_chat(chat_id)}")
-            
-            # Проверяем, является ли это сообщение из отслеживаемого чата
-            if not self.is_bot_chat(chat_id):
-                print(f"Чат {chat_id} не в списке отслеживаемых")
-                return
+            logger.debug("Сообщение от %s в чате %s (собственное: %s): %s",
+                         event.sender_id or 'Unknown', chat_id, is_self, message_text)
             
             # Не реагируем на собственные сообщения
             if is_self:
-                print("Пропускаем собственное сообщение")
+                metrics.inc('bot_messages_total', result='own')
                 return
+            metrics.inc('bot_messages_total', result='accepted')
             
-            # Обучаемся на входящем сообщении, если обучение включено
+            # Обучаемся на входящем сообщении, если обучение включено; раньше поиска
+            # сущности, чтобы ошибка поиска не лишала модель сообщения
             if self.config.learning_enabled and message_text:
-                self.learner.learn_from_message(message_text)
-                # Сохраняем данные каждые N сообщений
-                if random.random() < 0.1:  # ~10% шанс сохранения после каждого сообщения
-                    self.learner.save_data()
+                await self.enqueue_learning(chat_id, message_text)
             
-            # Обновляем время последнего сообщения в чате
-            self.last_message_time[chat_id] = time.time()
+            # Сущность чата для ответа берется из кэша
+            chat = await self.entities.get(chat_id, fetch=event.get_input_chat)
             
-            # Решаем, отвечать ли на сообщение
-            should_respond = random.random() < self.config.message_probability
+            # Обновляем время последнего сообщения в чате и переносим самостоятельное сообщение
+            self.last_message_time[chat_id] = time.time()
+            self.scheduler.schedule(chat_id, self.idle_deadline(chat_id))
             
-            if should_respond:
-                print(f"Будем отвечать на сообщение в чате {chat_id}")
-                # Добавляем случайную задержку перед ответом для имитации человека
-                delay = random.uniform(
-                    self.config.response_delay['min'],
-                    self.config.response_delay['max']
-                )
-                
-                # Иногда отображаем "печатает..." статус
-                try:
-                    if random.random() < 0.8:
-                        async with self.client.action(chat, 'typing'):
-                            await asyncio.sleep(delay)
-                            
-                            # Генерируем ответ
-                            response = self.learner.generate_response(message_text)
-                            
-                            # Делаем ответ более "человечным"
-                            response = self.learner.humanize_message(response)
-                            
-                            # Отправляем ответ
-                            await self.client.send_message(chat, response)
-                            print(f"Отправлен ответ в чат {chat_id}: {response}")
-                            logger.info(f"Отправлен ответ в чат {chat_id}: {response}")
-                    else:
-                        # Просто ждем без статуса печатания
-                        await asyncio.sleep(delay)
-                        
-                        # Генерируем ответ
-                        response = self.learner.generate_response(message_text)
-                        
-                        # Делаем ответ более "человечным"
-                        response = self.learner.humanize_message(response)
-                        
-                        # Отправляем ответ
-                        await self.client.send_message(chat, response)
-                        print(f"Отправлен ответ в чат {chat_id}: {response}")
-                        logger.info(f"Отправлен ответ в чат {chat_id}: {response}")
-                except Exception as e:
-                    print(f"Ошибка при отправке ответа в чат {chat_id}: {e}")
-                    logger.error(f"Ошибка при отправке ответа в чат {chat_id}: {e}")
+            # Ответ готовится один раз на весь всплеск сообщений, когда чат затихнет
+            if message_text:
+                self.replies.message(chat_id, chat, message_text)
         except Exception as e:
-            print(f"Ошибка при обработке сообщения: {e}")
+            metrics.inc('bot_messages_total', result='error')
             logger.error(f"Ошибка при обработке сообщения: {e}")
     
+    async def reply_to_burst(self, chat_id, chat, messages):
+        """Отвечает на всплеск сообщений чата одним сообщением."""
+        # Решаем, отвечать ли на сообщение
+        should_respond = random.random() < self.config.message_probability
+        if not should_respond:
+            metrics.inc('bot_replies_total', result='not_chosen')
+            return
+        
+        logger.debug("Будем отвечать на %d сообщений в чате %s", len(messages), chat_id)
+        # Добавляем случайную задержку перед ответом для имитации человека
+        delay = random.uniform(
+            self.config.response_delay['min'],
+            self.config.response_delay['max']
+        )
+        
+        # Самые свежие сообщения идут первыми: по ним проверяется приветствие
+        context = ' '.join(reversed(messages))
+        
+        # Генерируем "человечный" ответ в рабочем потоке и ставим его в очередь отправки;
+        # задержку (иногда со статусом "печатает...") выдерживает конвейер отправки
+        response = await self.run_in_worker(self.build_reply, chat_id, context, messages)
+        sent = self.sender.send(chat_id, chat, response, delay=delay, typing=random.random() < 0.8)
+        # Ждем отправки, чтобы координатор учитывал ответ как готовящийся
+        await asyncio.wait([sent])
+        if sent.cancelled():
+            metrics.inc('bot_replies_total', result='dropped')
+            logger.warning(f"Ответ в чат {chat_id} отброшен: очередь отправки переполнена")
+        elif sent.exception():
+            # Сама ошибка уже записана конвейером отправки
+            metrics.inc('bot_replies_total', result='failed')
+        else:
+            metrics.inc('bot_replies_total', result='sent')
+    
     async def initiate_conversation(self):
         """Иногда самостоятельно начинает диалог в чатах."""
         print("Запущен инициатор диалога")
-        while True:
-            # Проверяем каждый чат
-            for chat_id in self.config.chat_ids:
-                current_time = time.time()
-                last_time = self.last_message_time.get(chat_id, 0)
+        self.sync_schedule()
+        await self.scheduler.run()
+    
+    async def initiate_in_chat(self, chat_id):
+        """Срабатывает, когда чат затих; с некоторой вероятностью начинает в нем диалог."""
+        if chat_id not in self.tracked_chats.values():
+            return
+        current_time = time.time()
+        # Если чат так и не ожил, проверим его снова через 5-15 минут
+        next_check = current_time + random.randint(300, 900)
+        
+        try:
+            # С некоторой вероятностью инициируем разговор
+            if random.random() < 0.3:  # 30% шанс
+                # Генерируем "человечное" сообщение
+                if random.random() < 0.5:
+                    message = self.learner.humanize_message(self.learner.get_greeting())
+                else:
+                    message = await self.run_in_worker(self.build_reply, chat_id)
                 
-                # Если прошло достаточно времени с последнего сообщения
-                if current_time - last_time > random.randint(600, 3600):  # 10 минут - 1 час
-                    # С некоторой вероятностью инициируем разговор
-                    if random.random() < 0.3:  # 30% шанс
-                        try:
-                            # Генерируем сообщение
-                            if random.random() < 0.5:
-                                message = self.learner.get_greeting()
-                            else:
-                                message = self.learner.generate_response()
-                            
-                            # Делаем сообщение более "человечным"
-                            message = self.learner.humanize_message(message)
-                            
-                            # Получаем сущность чата
-                            try:
-                                entity = await self.client.get_entity(int(chat_id))
-                                print(f"Получена сущность чата {chat_id}: {entity}")
-                            except Exception as e:
-                                print(f"Ошибка при получении сущности чата {chat_id}: {e}")
-                                continue
-                            
-                            # Иногда отображаем "печатает..." статус
-                            if random.random() < 0.8:
-                                async with self.client.action(entity, 'typing'):
-                                    await asyncio.sleep(random.uniform(1, 3))
-                                    await self.client.send_message(entity, message)
-                                    print(f"Инициировано сообщение в чате {chat_id}: {message}")
-                            else:
-                                await self.client.send_message(entity, message)
-                                print(f"Инициировано сообщение в чате {chat_id}: {message}")
-                            
-                            # Обновляем время последнего сообщения
-                            self.last_message_time[chat_id] = current_time
-                            logger.info(f"Инициирован разговор в чате {chat_id}")
-                        except Exception as e:
-                            print(f"Ошибка при инициировании разговора в чате {chat_id}: {e}")
-                            logger.error(f"Ошибка при инициировании разговора в чате {chat_id}: {e}")
-            
-            # Ждем случайное время перед следующей проверкой
-            await asyncio.sleep(random.randint(300, 900))  # 5-15 минут
+                # Получаем сущность чата
+                try:
+                    entity = await self.entities.get(chat_id)
+                except Exception as e:
+                    logger.error(f"Ошибка при получении сущности чата {chat_id}: {e}")
+                    return
+                
+                # Иногда отображаем "печатает..." статус
+                if random.random() < 0.8:
+                    sent = self.sender.send(chat_id, entity, message, delay=random.uniform(1, 3), typing=True)
+                else:
+                    sent = self.sender.send(chat_id, entity, message)
+                # Отброшенное из переполненной очереди сообщение отменено: ждем его, не отменяясь сами
+                await asyncio.wait([sent])
+                if sent.cancelled():
+                    logger.warning(f"Сообщение для начала разговора в чате {chat_id} отброшено")
+                    return
+                sent.result()
+                logger.debug("Инициировано сообщение в чате %s: %s", chat_id, message)
+                
+                # Обновляем время последнего сообщения
+                self.last_message_time[chat_id] = current_time
+                next_check = self.idle_deadline(chat_id)
+                logger.info(f"Инициирован разговор в чате {chat_id}")
+        except Exception as e:
+            logger.error(f"Ошибка при инициировании разговора в чате {chat_id}: {e}")
+        finally:
+            # Если за время отправки пришло новое сообщение, его дедлайн уже назначен
+            if chat_id not in self.scheduler.scheduled():
+                self.scheduler.schedule(chat_id, next_check)
     
     async def run(self):
         """Запускает бота."""
+        self.log_startup('init', self.started)
+        # Модель загружается в рабочем потоке, пока клиент подключается
+        self.model_task = asyncio.create_task(self.load_model())
+        
         # Инициализация
         initialized = await self.initialize()
         if not initialized:
@@ -493,36 +3314,281 @@ class HumanLikeBot:
             try:
                 await self.process_incoming_message(event)
             except Exception as e:
-                print(f"Ошибка при обработке сообщения: {e}")
                 logger.error(f"Ошибка при обработке сообщения: {e}")
         
+        if self.config.metrics_port:
+            # Обработчики занимают порты сразу за портом супервизора
+            port = self.config.metrics_port + (self.shard.index + 1 if self.shard is not None else 0)
+            self.metrics_server = await metrics.start_server(port)
+            print(f"Метрики доступны на http://127.0.0.1:{port}/metrics")
+        
+        # Запускаем обучение из очереди в отдельной задаче
+        self.learn_task = asyncio.create_task(self.learn_worker())
+        self.maintenance_task = asyncio.create_task(self.maintenance())
+        self.precompute_task = asyncio.create_task(self.precompute_worker())
+        self.config_task = asyncio.create_task(self.watch_config())
+        
+        # Пропущенные за время остановки сообщения догружаются в фоне, не задерживая обработку новых
+        self.start_catch_up()
+        self.connection_task = asyncio.create_task(self.watch_connection())
+        if self.shard is not None:
+            self.shard_task = asyncio.create_task(self.watch_shard())
+        
         # Запускаем инициатор разговора в отдельной задаче
         print("Запуск инициатора диалога")
-        asyncio.create_task(self.initiate_conversation())
+        self.initiate_task = asyncio.create_task(self.initiate_conversation())
         
-        # Отправляем приветственное сообщение в каждый чат при запуске
-        print("Отправка приветственных сообщений")
-        for chat_id in self.config.chat_ids:
-            try:
-                entity = await self.client.get_entity(int(chat_id))
-                greeting = self.learner.humanize_message(self.learner.get_greeting())
-                await self.client.send_message(entity, greeting)
-                print(f"Отправлено приветствие в чат {chat_id}: {greeting}")
-                logger.info(f"Отправлено приветствие в чат {chat_id}: {greeting}")
-            except Exception as e:
-                print(f"Ошибка при отправке приветствия в чат {chat_id}: {e}")
-                logger.error(f"Ошибка при отправке приветствия в чат {chat_id}: {e}")
+        # Проверка чатов и приветствия идут в фоне: обработчик уже принимает сообщения
+        self.warm_up_task = asyncio.create_task(self.warm_up())
         
         print("Бот запущен и готов к работе")
-        logger.info("Бот запущен и готов к работе")
+        self.log_startup('ready', self.started)
         
         # Поддерживаем работу бота до закрытия
         await self.client.run_until_disconnected()
 
 # Функция для запуска бота
-async def main():
-    bot = HumanLikeBot()
-    await bot.run()
+async def main(shard=None):
+    bot = HumanLikeBot(shard)
+    try:
+        await bot.run()
+    finally:
+        await bot.shutdown()
+
+# Консистентное хеширование чатов по процессам
+class HashRing:
+    """Кольцо хешей: у каждого узла replicas точек, ключ достается ближайшей точке по часовой стрелке.
+
+    Когда узел пропадает, переезжают только его ключи, остальные остаются на месте.
+    """
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self.nodes = set()
+        self._hashes = []
+        self._owners = []
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key):
+        # crc32 для похожих ключей дает точки с перекосом, поэтому берем начало md5
+        return int.from_bytes(hashlib.md5(str(key).encode('utf-8')).digest()[:8], 'big')
+
+    def add(self, node):
+        self.nodes.add(node)
+        self._rebuild()
+
+    def remove(self, node):
+        self.nodes.discard(node)
+        self._rebuild()
+
+    def _rebuild(self):
+        points = sorted((self._hash(f"{node}#{i}"), node) for node in self.nodes for i in range(self.replicas))
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def owner(self, key):
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._owners[index]
+
+# Связь процесса-обработчика с супервизором
+class ShardLink:
+    """Сессия обработчика, состав работающих обработчиков и каналы связи с супервизором."""
+    def __init__(self, session, index, members, control, updates, cursors=None):
+        self.session = session
+        self.index = index  # Номер сессии в worker_sessions
+        self.ring = HashRing(members)
+        self.control = control  # Канал команд супервизора
+        self.updates = updates  # Очередь сообщений для обучения и позиций чатов в процесс супервизора
+        self.cursors = cursors or {}  # Позиции чатов у супервизора на момент запуска
+
+    def owns(self, chat_id):
+        return self.ring.owner(str(chat_id)) == self.session
+
+def run_shard_worker(session, index, members, control, updates, cursors=None):
+    """Точка входа процесса-обработчика."""
+    try:
+        asyncio.run(main(ShardLink(session, index, members, control, updates, cursors)))
+    except KeyboardInterrupt:
+        pass
+
+# Режим нескольких процессов
+class Supervisor:
+    """Запускает по процессу-обработчику на каждую сессию из worker_sessions и один пишет модели.
+
+    Чаты делятся между обработчиками консистентным хешированием. Обработчики
+    читают модели из отображаемых в память снимков и пересылают сообщения
+    для обучения супервизору; он единственный пишет журналы и раз в
+    shard_sync_interval секунд сворачивает их в снимки. Чаты упавшего
+    обработчика переходят к остальным, сам он перезапускается через
+    RESTART_DELAY секунд; если он снова падает вскоре после запуска, пауза
+    удваивается, а после MAX_FAST_EXITS таких падений подряд сессия больше не
+    перезапускается. Позиции чатов для догрузки пропущенного тоже ведет
+    супервизор: обработчики присылают ему их сдвиги и получают их вместе с
+    новым составом, чтобы новый владелец чата не изучал его заново. Сессии
+    должны быть авторизованы заранее, а аккаунты должны состоять во всех
+    чатах: любой чат может перейти к любой сессии.
+    """
+    POLL_INTERVAL = 1  # Как часто проверять обработчики, сек
+    RESTART_DELAY = 10  # Через сколько перезапускать упавший обработчик, сек
+    MAX_RESTART_DELAY = 600  # Предел паузы перед перезапуском, сек
+    FAST_EXIT = 60  # Обработчик, проработавший меньше, считается упавшим сразу после запуска, сек
+    MAX_FAST_EXITS = 5  # После стольких быстрых падений подряд сессия не перезапускается
+    STOP_TIMEOUT = 30  # Сколько ждать остановки обработчиков, сек
+
+    def __init__(self):
+        # Модели пишет бот без клиента: обучение, сохранение и обслуживание те же, что в обычном режиме
+        self.writer = HumanLikeBot()
+        self.sessions = list(self.writer.config.worker_sessions)
+        self.context = multiprocessing.get_context('spawn')
+        self.updates = self.context.Queue()
+        self.members = set(self.sessions)  # Обработчики, между которыми делятся чаты
+        self.workers = {}  # сессия -> (процесс, канал команд)
+        self.restart_at = {}  # сессия -> когда перезапустить упавший обработчик
+        self.started_at = {}  # сессия -> когда запущен обработчик
+        self.fast_exits = defaultdict(int)  # сессия -> быстрых падений подряд
+        self.given_up = set()  # Сессии, которые больше не перезапускаются
+        self.restarts = 0
+        self.stopping = False
+        self.feed_task = None
+        metrics.register('supervisor', self.collect_metrics)
+
+    def start_worker(self, session):
+        control, worker_end = self.context.Pipe()
+        process = self.context.Process(target=run_shard_worker, name=f"bot-{session}",
+                                       args=(session, self.sessions.index(session), sorted(self.members),
+                                             worker_end, self.updates, self.writer.cursors.snapshot()))
+        process.start()
+        worker_end.close()
+        self.workers[session] = (process, control)
+        self.started_at[session] = time.monotonic()
+        logger.info(f"Запущен обработчик {session} (pid {process.pid})")
+
+    def broadcast(self, command, payload=None):
+        for session, (_, control) in self.workers.items():
+            try:
+                control.send((command, payload))
+            except (EOFError, OSError) as e:
+                logger.error(f"Не удалось отправить команду обработчику {session}: {e}")
+
+    def check_workers(self):
+        """Убирает упавшие обработчики из кольца и перезапускает их после паузы."""
+        now = time.monotonic()
+        changed = False
+        for session, (process, control) in list(self.workers.items()):
+            if process.is_alive():
+                continue
+            del self.workers[session]
+            control.close()
+            self.members.discard(session)
+            changed = True
+            print(f"Обработчик {session} завершился (код {process.exitcode}), его чаты переходят к остальным")
+            logger.error(f"Обработчик {session} завершился с кодом {process.exitcode}")
+            if now - self.started_at.pop(session) < self.FAST_EXIT:
+                self.fast_exits[session] += 1
+            else:
+                self.fast_exits[session] = 0
+            if self.fast_exits[session] >= self.MAX_FAST_EXITS:
+                # Скорее всего, ошибка постоянная (сессия не авторизована и т.п.)
+                self.given_up.add(session)
+                print(f"Обработчик {session} падает сразу после запуска, больше не перезапускаем")
+                logger.error(f"Обработчик {session} упал {self.fast_exits[session]} раз подряд, перезапуск отменен")
+                continue
+            # Экспоненциальная пауза: 10, 20, 40... секунд при повторяющихся быстрых падениях
+            delay = min(self.RESTART_DELAY * 2 ** self.fast_exits[session], self.MAX_RESTART_DELAY)
+            self.restart_at[session] = now + delay
+        for session, restart_at in list(self.restart_at.items()):
+            if restart_at <= now:
+                del self.restart_at[session]
+                self.members.add(session)
+                self.start_worker(session)
+                self.restarts += 1
+                changed = True
+        if changed:
+            # Вместе с составом - позиции чатов: новый владелец догрузит чат с них
+            self.broadcast('members', (sorted(self.members), self.writer.cursors.snapshot()))
+
+    async def receive(self, update):
+        """Принимает от обработчика пачку сообщений для обучения или сдвинувшиеся позиции чатов."""
+        kind, payload = update
+        if kind == 'cursors':
+            for chat_id, message_id in payload.items():
+                self.writer.cursors.advance(chat_id, message_id)
+        else:
+            for item in payload:
+                await self.writer.learn_queue.put(item)
+
+    async def feed(self):
+        """Передает сообщения от обработчиков в очередь обучения писателя."""
+        loop = asyncio.get_running_loop()
+        while not self.stopping:
+            try:
+                update = await loop.run_in_executor(None, self.updates.get, True, self.POLL_INTERVAL)
+            except Empty:
+                continue
+            await self.receive(update)
+
+    def collect_metrics(self):
+        return [('bot_shard_workers', {}, len(self.workers)),
+                ('bot_shard_restarts', {}, self.restarts),
+                ('bot_shard_given_up', {}, len(self.given_up))]
+
+    async def run(self):
+        writer = self.writer
+        if not self.sessions:
+            print("Для режима --supervisor заполните worker_sessions в config.json")
+            logger.error("Режим --supervisor: список worker_sessions пуст")
+            return
+        if writer.config.metrics_port:
+            writer.metrics_server = await metrics.start_server(writer.config.metrics_port)
+        writer.model_task = asyncio.create_task(writer.load_model())
+        writer.learn_task = asyncio.create_task(writer.learn_worker())
+        writer.maintenance_task = asyncio.create_task(writer.maintenance())
+        self.feed_task = asyncio.create_task(self.feed())
+        for session in self.sessions:
+            self.start_worker(session)
+        print(f"Запущено обработчиков: {len(self.workers)}")
+        synced = time.monotonic()
+        while True:
+            await asyncio.sleep(self.POLL_INTERVAL)
+            self.check_workers()
+            if not self.workers and not self.restart_at:
+                print("Не осталось работающих обработчиков, супервизор останавливается")
+                logger.error("Все обработчики отключены после повторяющихся падений")
+                return
+            if writer.model_ready.is_set() and time.monotonic() - synced >= writer.config.shard_sync_interval:
+                synced = time.monotonic()
+                await writer.run_in_worker(writer.publish_models)
+
+    async def shutdown(self):
+        """Останавливает обработчики, дообучается на всем, что они прислали, и сохраняет модели."""
+        self.broadcast('stop')
+        deadline = time.monotonic() + self.STOP_TIMEOUT
+        while any(process.is_alive() for process, _ in self.workers.values()) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        for session, (process, _) in self.workers.items():
+            if process.is_alive():
+                logger.warning(f"Обработчик {session} не остановился за {self.STOP_TIMEOUT} с")
+                process.terminate()
+        self.stopping = True
+        if self.feed_task:
+            await self.feed_task
+        while True:
+            try:
+                update = self.updates.get_nowait()
+            except Empty:
+                break
+            await self.receive(update)
+        await self.writer.shutdown()
+
+async def supervise():
+    supervisor = Supervisor()
+    try:
+        await supervisor.run()
+    finally:
+        await supervisor.shutdown()
 
 # Вспомогательная функция для настройки конфигурации
 def setup_config():
@@ -564,12 +3630,444 @@ def setup_config():
     
     print("\nНастройка завершена. Конфигурация сохранена в config.json")
 
+# Потоковое чтение экспорта Telegram Desktop
+EXPORT_MESSAGES_RE = re.compile(r'"messages"\s*:\s*\[')
+
+def iter_export_messages(export_file, chunk_size=1 << 20):
+    """Читает сообщения из result.json экспорта Telegram Desktop, не загружая файл целиком.
+
+    Файл читается блоками; каждое сообщение разбирается raw_decode, как только
+    оно целиком попало в буфер. Подходит и для экспорта одного чата, и для
+    экспорта всего аккаунта (несколько списков "messages").
+    """
+    decoder = json.JSONDecoder()
+    with open(export_file, 'r', encoding='utf-8') as f:
+        buffer, pos, in_messages = '', 0, False
+        while True:
+            if in_messages:
+                while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                    pos += 1
+                if pos < len(buffer):
+                    if buffer[pos] == ']':
+                        in_messages = False
+                        pos += 1
+                        continue
+                    try:
+                        message, pos = decoder.raw_decode(buffer, pos)
+                        yield message
+                        continue
+                    except ValueError:
+                        pass  # Сообщение обрывается на границе блока, дочитываем
+            else:
+                match = EXPORT_MESSAGES_RE.search(buffer, pos)
+                if match:
+                    pos, in_messages = match.end(), True
+                    continue
+                # Ключ может быть разрезан границей блока, хвост оставляем
+                pos = max(pos, len(buffer) - 32)
+            chunk = f.read(chunk_size)
+            if not chunk:
+                if in_messages:
+                    raise ValueError(f"Экспорт {export_file} оборван внутри списка сообщений")
+                return
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+def export_message_text(message):
+    """Текст сообщения экспорта: строка или список из строк и фрагментов с разметкой."""
+    if message.get('type', 'message') != 'message':
+        return ''
+    text = message.get('text', '')
+    if isinstance(text, list):
+        text = ''.join(part if isinstance(part, str) else part.get('text', '') for part in text)
+    return text
+
+# Функции рабочих процессов массового обучения (на уровне модуля, чтобы их можно было передать в процесс)
+_train_worker = {}
+
+def _init_train_worker(tokenizer_name, greetings):
+    _train_worker['tokenizer'] = make_tokenizer(tokenizer_name)
+    _train_worker['greetings'] = GreetingMatcher(greetings)
+
+def _count_messages(messages, pattern_limit, response_limit):
+    """Считает переходы в пачке сообщений и отбирает последние паттерны и ответы."""
+    tokenizer = _train_worker['tokenizer']
+    greeting_matcher = _train_worker['greetings']
+    transitions = {}
+    patterns = deque(maxlen=pattern_limit)
+    responses = {}
+    for message in messages:
+        if not message or len(message) < 2:
+            continue
+        message = message.lower().strip()
+        tokens = tokenizer.tokenize(message)
+        for word, next_word in zip(tokens, tokens[1:]):
+            row = transitions.setdefault(word, {})
+            row[next_word] = row.get(next_word, 0) + 1
+        if len(message) > 3:
+            patterns.append(message)
+        for key, response in MessageLearner.message_responses(message, greeting_matcher):
+            if key not in responses:
+                responses[key] = deque(maxlen=response_limit)
+            responses[key].append(response)
+    # Модель все равно хранит только последние сообщения, лишнее не передаем обратно
+    return transitions, list(patterns), {key: list(items) for key, items in responses.items()}
+
+# Массовое обучение на истории чатов
+class BulkTrainer:
+    """Обучает модель на потоке сообщений в пуле процессов.
+
+    Сообщения режутся на пачки по chunk_size и считаются в рабочих процессах;
+    частичные счетчики вливаются в модель в порядке подачи. В работе
+    одновременно не больше window пачек, поэтому память не зависит от
+    размера истории.
+    """
+    def __init__(self, learner, tokenizer_name='regex', workers=None, chunk_size=2000, window=None,
+                 pattern_limit=5000, response_limit=2000):
+        self.learner = learner
+        self.chunk_size = chunk_size
+        self.pattern_limit = pattern_limit
+        self.response_limit = response_limit
+        workers = workers or os.cpu_count() or 1
+        self.pool = ProcessPoolExecutor(workers, initializer=_init_train_worker,
+                                        initargs=(tokenizer_name, list(learner.greetings)))
+        self.window = window or 2 * workers
+        self._chunk = []
+        self._futures = deque()
+        self.messages = 0
+        self.started = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is None:
+            self.finish()
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+    def feed(self, messages):
+        for message in messages:
+            if message:
+                self._chunk.append(message)
+                if len(self._chunk) >= self.chunk_size:
+                    self._submit()
+
+    def _submit(self):
+        self._futures.append(self.pool.submit(_count_messages, self._chunk,
+                                              self.pattern_limit, self.response_limit))
+        self.messages += len(self._chunk)
+        self._chunk = []
+        while len(self._futures) >= self.window:
+            self._merge()
+
+    def _merge(self):
+        self.learner.learn_counts(*self._futures.popleft().result())
+        # Дельта уходит в журнал сразу, чтобы не копить ее в памяти
+        self.learner.save_data()
+
+    def finish(self):
+        if self._chunk:
+            self._submit()
+        while self._futures:
+            self._merge()
+        elapsed = time.perf_counter() - self.started
+        print(f"Обучено на {self.messages} сообщениях за {elapsed:.1f} с "
+              f"({self.messages / elapsed if elapsed else 0:,.0f} сообщений/с)")
+
+async def fetch_history(config, trainer, chat_id, limit=None, page_size=1000):
+    """Загружает историю чата через Telegram (от старых сообщений к новым) и отдает ее trainer."""
+    client = TelegramClient(config.session_name, config.api_id, config.api_hash)
+    await client.start()
+    loop = asyncio.get_running_loop()
+    try:
+        entity = await client.get_entity(int(chat_id))
+        min_id = 0
+        if limit:
+            # reverse=True с limit отдал бы самые старые сообщения; находим начало последних limit
+            oldest = await client.get_messages(entity, limit=1, add_offset=limit - 1)
+            if oldest:
+                min_id = oldest[0].id - 1
+        page = []
+        async for message in client.iter_messages(entity, min_id=min_id, reverse=True):
+            page.append(message.message)
+            if len(page) >= page_size:
+                # Подсчет и слияние не должны останавливать клиент
+                await loop.run_in_executor(None, trainer.feed, page)
+                page = []
+        await loop.run_in_executor(None, trainer.feed, page)
+    finally:
+        await client.disconnect()
+
+def train_command(argv):
+    """Точка входа --train: начальное обучение модели на экспортах и истории чатов."""
+    parser = argparse.ArgumentParser(prog='1.py --train',
+                                     description="Обучение модели на истории чатов. Бот в это время должен быть остановлен.")
+    parser.add_argument('exports', nargs='*', help="Файлы result.json из экспорта Telegram Desktop")
+    parser.add_argument('--history', metavar='CHAT_ID', help="Загрузить историю чата через Telegram")
+    parser.add_argument('--limit', type=int, default=None, help="Сколько последних сообщений истории загрузить")
+    parser.add_argument('--chat', metavar='CHAT_ID', help="Обучать модель этого чата вместо общей")
+    parser.add_argument('--workers', type=int, default=None, help="Количество рабочих процессов")
+    args = parser.parse_args(argv)
+    if not args.exports and not args.history:
+        parser.error("укажите файлы экспорта или --history")
+
+    config = BotConfig()
+    if args.chat:
+        os.makedirs(config.models_dir, exist_ok=True)
+        data_file = os.path.join(config.models_dir, f"{args.chat}.json")
+    else:
+        data_file = 'message_data.json'
+    # Индекс поиска и кэш ответов строятся при загрузке модели ботом, здесь они только замедлили бы слияние
+    learner = MessageLearner(data_file,
+                             pattern_limit=config.pattern_limit,
+                             response_limit=config.response_limit,
+                             eviction_policy=config.eviction_policy,
+                             tokenizer=make_tokenizer(config.tokenizer),
+                             retrieval=False,
+                             response_cache_size=0)
+    try:
+        with BulkTrainer(learner, config.tokenizer, workers=args.workers,
+                         pattern_limit=config.pattern_limit, response_limit=config.response_limit) as trainer:
+            for export_file in args.exports:
+                print(f"Чтение экспорта {export_file}")
+                trainer.feed(export_message_text(message) for message in iter_export_messages(export_file))
+            if args.history:
+                print(f"Загрузка истории чата {args.history}")
+                asyncio.run(fetch_history(config, trainer, args.history, args.limit))
+    finally:
+        # Журнал сворачивается в снимок, который бот загрузит при запуске
+        learner.close()
+    print(f"Модель сохранена в {learner.journal.snapshot_file}")
+
+# Перевод моделей в двоичный формат
+def convert_models():
+    """Однократно переводит JSON-снимки общей модели и моделей чатов в двоичный формат."""
+    config = BotConfig()
+    data_files = ['message_data.json']
+    if os.path.isdir(config.models_dir):
+        data_files += sorted(os.path.join(config.models_dir, name)
+                             for name in os.listdir(config.models_dir) if name.endswith('.json'))
+    for data_file in data_files:
+        if not os.path.exists(data_file):
+            continue
+        journal = ModelJournal(data_file, pattern_limit=config.pattern_limit,
+                               response_limit=config.response_limit, policy=config.eviction_policy)
+        if os.path.exists(journal.snapshot_file):
+            print(f"{data_file}: уже есть двоичный снимок {journal.snapshot_file}")
+            continue
+        started = time.perf_counter()
+        converted = journal.compact(force=True).result()
+        journal.close()
+        if converted:
+            print(f"{data_file} -> {journal.snapshot_file} за {time.perf_counter() - started:.1f} с "
+                  f"(JSON-файл больше не используется и может быть удален)")
+        else:
+            print(f"{data_file}: ошибка преобразования, подробности в логе")
+
+# Корпус сообщений для бенчмарков
+def load_corpus(corpus_file=None, size=20000, seed=42):
+    """Читает корпус (по строке на сообщение) или строит синтетический.
+
+    Синтетический корпус: базовые фразы, эмодзи и редкие "слова" с частотами по закону Ципфа.
+    """
+    if corpus_file:
+        with open(corpus_file, 'r', encoding='utf-8') as f:
+            messages = [line.strip() for line in f if line.strip()]
+        # Повторяем короткий корпус до нужного размера
+        return [messages[i % len(messages)] for i in range(size)] if messages else []
+    words = ("ку бро как дела что нового норм понятно да ладно серьезно жесть "
+             "ну и ну офигеть кстати вчера сегодня завтра пойдем в кино 👍 😂 🔥 ?! ... , .").split()
+    words += [f"слово{i}" for i in range(5000)]
+    weights = [1 / (rank + 1) for rank in range(len(words))]
+    rng = random.Random(seed)
+    return [' '.join(rng.choices(words, weights, k=rng.randint(3, 20))) for _ in range(size)]
+
+# Сравнение производительности токенизаторов
+def benchmark_tokenizers(corpus_file=None, rounds=5):
+    """Измеряет пропускную способность токенизаторов на корпусе (по строке на сообщение)."""
+    messages = [message.lower() for message in load_corpus(corpus_file)]
+
+    print(f"Сообщений в корпусе: {len(messages)}")
+    for name in TOKENIZERS:
+        try:
+            tokenizer = TOKENIZERS[name]()
+        except (ImportError, LookupError, OSError) as e:
+            print(f"{name}: недоступен ({e})")
+            continue
+        best = None
+        for _ in range(rounds):
+            start = time.perf_counter()
+            tokens = sum(len(tokenizer.tokenize(message)) for message in messages)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print(f"{name}: {len(messages) / best:,.0f} сообщений/с, {tokens / best:,.0f} токенов/с")
+
+# Заглушки Telegram для офлайн-бенчмарка
+class FakeMessage:
+    def __init__(self, message_id, text):
+        self.id = message_id
+        self.message = text
+
+class FakeEvent:
+    """Минимальная замена events.NewMessage.Event."""
+    def __init__(self, chat_id, message_id, text, sender_id=1, out=False):
+        self.chat_id = chat_id
+        self.sender_id = sender_id
+        self.out = out
+        self.id = message_id
+        self.message = FakeMessage(message_id, text)
+
+    async def get_input_chat(self):
+        return InputPeerChat(chat_id=abs(self.chat_id))
+
+class FakeClient:
+    """Замена TelegramClient без сети и задержек; запоминает отправленные сообщения."""
+    def __init__(self):
+        self.sent = 0
+
+    async def get_entity(self, peer_id):
+        return InputPeerChat(chat_id=abs(int(peer_id)))
+
+    async def get_input_entity(self, peer_id):
+        return await self.get_entity(peer_id)
+
+    @contextlib.asynccontextmanager
+    async def action(self, entity, action):
+        yield
+
+    async def send_message(self, entity, text):
+        self.sent += 1
+        return FakeMessage(self.sent, text)
+
+# Офлайн-бенчмарк обработчика сообщений
+def timed_stage(stats, stage, func):
+    """Оборачивает функцию так, что ее суммарное время копится в stats[stage]."""
+    def wrapper(*args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            stats[stage] += time.perf_counter() - start
+    return wrapper
+
+def resident_memory_mb():
+    """Текущий объем резидентной памяти процесса (на Linux), иначе пиковый."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+async def replay_corpus(messages, chats=5):
+    """Прогоняет сообщения через process_incoming_message бота с FakeClient."""
+    bot = HumanLikeBot()
+    await bot.load_model()
+    bot.client = FakeClient()
+    bot.entities = EntityCache(bot.client)
+    bot.sender = bot.make_sender(bot.client)
+    stages = defaultdict(float)
+    bot.learn_messages = timed_stage(stages, 'learn', bot.learn_messages)
+    bot.build_reply = timed_stage(stages, 'generate', bot.build_reply)
+    bot.save_models = timed_stage(stages, 'save', bot.save_models)
+    bot.learn_task = asyncio.create_task(bot.learn_worker())
+
+    memory_before = resident_memory_mb()
+    latencies = []
+    start = time.perf_counter()
+    for message_id, text in enumerate(messages, 1):
+        event = FakeEvent(-(message_id % chats + 1), message_id, text)
+        handler_start = time.perf_counter()
+        await bot.process_incoming_message(event)
+        latencies.append(time.perf_counter() - handler_start)
+    # Дожидаемся обучения, ответов и отправки
+    await bot.learn_queue.join()
+    while bot.replies.busy():
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    memory_growth = resident_memory_mb() - memory_before
+
+    close_start = time.perf_counter()
+    await bot.shutdown()
+    stages['close'] = time.perf_counter() - close_start
+
+    latencies.sort()
+    return {
+        'messages': len(messages),
+        'seconds': elapsed,
+        'messages_per_sec': len(messages) / elapsed,
+        'handler_p50_ms': 1000 * latencies[len(latencies) // 2],
+        'handler_p99_ms': 1000 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+        'stage_seconds': dict(stages),
+        'replies_sent': bot.client.sent,
+        'memory_growth_mb': memory_growth,
+    }
+
+def benchmark_replay(corpus_file=None, sizes=(1000, 5000, 20000), out_file='bench_results.json'):
+    """Измеряет пропускную способность, задержки и рост памяти бота на корпусах разного размера."""
+    import tempfile
+
+    previous = None
+    if os.path.exists(out_file):
+        with open(out_file, 'r', encoding='utf-8') as f:
+            previous = {run['messages']: run for run in json.load(f).get('runs', [])}
+
+    bench_config = {
+        'api_id': 1, 'api_hash': 'bench', 'chat_ids': [str(-(i + 1)) for i in range(5)],
+        'response_delay': {'min': 0, 'max': 0}, 'message_probability': 0.7,
+        'reply_quiet_period': 0, 'reply_max_wait': 0,
+        'send_rate_per_chat': 1e9, 'send_rate_global': 1e9, 'send_queue_size': 1000000,
+    }
+    out_path = os.path.abspath(out_file)
+    cwd = os.getcwd()
+    runs = []
+    for size in sizes:
+        messages = load_corpus(corpus_file, size)
+        with tempfile.TemporaryDirectory() as workdir:
+            # Модели и конфигурация создаются в чистом временном каталоге
+            os.chdir(workdir)
+            try:
+                with open('config.json', 'w', encoding='utf-8') as f:
+                    json.dump(bench_config, f)
+                # Вывод обработчика уходит в никуда, но время на него учитывается
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    result = asyncio.run(replay_corpus(messages))
+            finally:
+                os.chdir(cwd)
+        runs.append(result)
+
+        line = (f"{size} сообщений: {result['messages_per_sec']:,.0f} сообщений/с, "
+                f"p50 {result['handler_p50_ms']:.3f} мс, p99 {result['handler_p99_ms']:.3f} мс, "
+                f"рост памяти {result['memory_growth_mb']:.1f} МБ")
+        if previous and size in previous:
+            change = result['messages_per_sec'] / previous[size]['messages_per_sec'] - 1
+            line += f", {change:+.1%} к прошлому запуску"
+        print(line)
+        print("  время этапов, с: " + ", ".join(f"{stage} {seconds:.3f}"
+                                                for stage, seconds in result['stage_seconds'].items()))
+
+    with open(out_path, 'w', encoding='utf-8') as f:
+        json.dump({'timestamp': time.time(), 'corpus': corpus_file or 'synthetic', 'runs': runs},
+                  f, indent=4, ensure_ascii=False)
+    print(f"Результаты сохранены в {out_path}")
+
 # Точка входа для запуска бота
 if __name__ == "__main__":
-    import sys
-    
     if len(sys.argv) > 1 and sys.argv[1] == '--setup':
         setup_config()
+    elif len(sys.argv) > 1 and sys.argv[1] == '--train':
+        train_command(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == '--supervisor':
+        try:
+            asyncio.run(supervise())
+        except KeyboardInterrupt:
+            print("Бот остановлен")
+    elif len(sys.argv) > 1 and sys.argv[1] == '--convert-model':
+        convert_models()
+    elif len(sys.argv) > 1 and sys.argv[1] == '--bench-tokenizer':
+        benchmark_tokenizers(sys.argv[2] if len(sys.argv) > 2 else None)
+    elif len(sys.argv) > 1 and sys.argv[1] == '--bench':
+        benchmark_replay(sys.argv[2] if len(sys.argv) > 2 else None)
     else:
         try:
             asyncio.run(main())